@@ -2,6 +2,6 @@
 #A library for handling interactions with the Luminate Web Services SOAP API
 
 
-__all__ = ['local_settings','interface_data','utilities','exceptions','data_structures','soap_message','session','controller','database']
+__all__ = ['local_settings','interface_data','utilities','exceptions','data_structures','soap_message','session','controller','database','export','cache','tracing','trace_analysis','rangeset']
 
 
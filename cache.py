@@ -0,0 +1,90 @@
+#local disk cache of SOAP responses, so that re-running a sync or developing a loader doesn't have to hit Luminate again for the same pages
+
+from hashlib import sha256
+from os import listdir, makedirs, remove, replace, stat, utime
+from os.path import join
+from time import time
+from threading import get_ident
+
+
+class ResponseCache():
+	"""Stores response texts on local disk under a hash of the normalized request body and sync window.
+	Entries older than ttl seconds are ignored and removed (ttl=None keeps them until evicted), and once the cache holds more than maxsize bytes
+	the least recently used entries are evicted.  Use is tracked through the access time of each file, which is set on every hit."""
+	def __init__(self,path,ttl=86400,maxsize=1024**3):
+		self.path = path
+		self.ttl = ttl
+		self.maxsize = maxsize
+		self.size = None
+		makedirs(path,exist_ok=True)
+
+	def key(self,body,window=None):
+		"""Returns the cache key for a request body (bytes) and the sync window (start, end) it was made under, if any."""
+		h = sha256(body)
+		if window is not None:
+			h.update(('|%s|%s' % window).encode('utf-8'))
+		return h.hexdigest()
+
+	def get(self,key):
+		"""Returns the cached response text for key, or None on a miss."""
+		fname = join(self.path,key)
+		try:
+			st = stat(fname)
+		except FileNotFoundError:
+			return None
+		now = time()
+		if self.ttl is not None and now - st.st_mtime > self.ttl:
+			try:
+				remove(fname)
+			except FileNotFoundError:
+				pass
+			return None
+		try:
+			with open(fname,'rt',encoding='utf-8') as cachefile:
+				text = cachefile.read()
+		except FileNotFoundError:
+			return None
+		utime(fname,(now,st.st_mtime))
+		return text
+
+	def put(self,key,text):
+		fname = join(self.path,key)
+		tmpname = '%s.%s.tmp' % (fname, str(get_ident()))
+		with open(tmpname,'wt',encoding='utf-8') as cachefile:
+			cachefile.write(text)
+		#rename into place so a concurrent reader never sees a partly written entry
+		replace(tmpname,fname)
+		if self.size is None:
+			self.evict()
+		else:
+			self.size += len(text)
+			if self.size > self.maxsize:
+				self.evict()
+
+	def evict(self):
+		"""Recounts the size of the cache and removes the least recently used entries until it is within maxsize.
+		put only calls this when its running count of the size says the cache has grown too large."""
+		entries = []
+		total = 0
+		for fname in listdir(self.path):
+			if fname.endswith('.tmp'):
+				continue
+			try:
+				st = stat(join(self.path,fname))
+			except FileNotFoundError:
+				continue
+			entries.append((st.st_atime,st.st_size,fname))
+			total += st.st_size
+		self.size = total
+		if total <= self.maxsize:
+			return
+		entries.sort()
+		for (atime, size, fname) in entries:
+			try:
+				remove(join(self.path,fname))
+			except FileNotFoundError:
+				pass
+			total -= size
+			if total <= self.maxsize:
+				break
+		self.size = total
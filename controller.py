@@ -1,22 +1,26 @@
 #purpose of this module is to offer up a high level of abstraction for managing bulk download operations
 #conceptually this could be part of the session object, but I think it's better not to clutter that further
 
-from .session import SOAPSession, recordtypes
+from .session import SOAPSession, recordtypes, open_sessions
 from os import chdir
 from csv import reader
-from .utilities import  isodate_to_jsdate
+from .utilities import  isodate_to_jsdate, moment, watermark_floor
 from .exceptions import SOAPError
-from .database import curs, DBThread
+from .database import curs, DBThread, RowStream, stage_name, create_stage, drop_stage, loader_lock
+from .tracing import trace, trace_unit, unit_key
+from .rangeset import RangeSet
 import pickle
 from threading import Thread, Lock
 from requests.exceptions import RequestException
 from queue import Queue
-from .local_settings import settings, debug, pagelimits, timefields, pks,longdates
+from multiprocessing import get_context
+from .local_settings import settings, debug, pagelimits, timefields, pks,longdates, soap_uname, soap_pw
 from psycopg2 import IntegrityError, DatabaseError, OperationalError, ProgrammingError
 from io import StringIO
-from math import floor
+from math import floor, ceil
 from datetime import date
-from time import mktime
+from itertools import islice
+from time import mktime, time
 
 workerthreads = settings['workerthreads']
 
@@ -24,6 +28,25 @@ workerthreads = settings['workerthreads']
 
 dontquery = ['Donation']
 
+#query mode downloads seek past the last record seen instead of asking for page offsets when this is set
+keyset = settings.get('keyset_queries',False)
+keyset_retries = 3
+
+#number of completed units allowed to pile up in staging tables before they are merged with a single db_load; 0 merges after every unit
+merge_batch = settings.get('merge_batch',0)
+
+#gather record counts for the whole run before downloading anything, to size pages and report an ETA as it goes
+count_first = settings.get('count_first',False)
+
+#download opnames that draw on the same element and operation together, once per window, rather than once per opname
+shared_fetch = settings.get('shared_fetch',False)
+
+#number of processes db_sync_sharded spreads a run across
+shard_processes = settings.get('shard_processes',2)
+
+#seconds of overlap re-queried behind the stored high watermark on each incremental run, to catch records committed out of order
+watermark_overlap = settings.get('watermark_overlap',900)
+
 
 class DownloadThread(Thread):
 	def __init__(self,parent,session,task_queue,db_queue,group=None,target=None,name=None):
@@ -40,24 +63,40 @@ class DownloadThread(Thread):
 	def run(self):
 		while True:
 			inst = self.task_queue.get()
-			
+			trace_unit(unit_key(inst.opn,inst.op,self.parent.dbthread.start_date,inst.page))
+			trace('dequeued')
+
 			try:
 				if inst.soap == 'dl':
 					if debug:
 						print('%s beginning work on %s %s page %s' % (self.name,inst.opn,inst.op,str(inst.page)))
 					response = self.session.download(inst.el,inst.fields,inst.op,pagesize=pagelimits[inst.el],page=inst.page)
 					results = response.list_results()
+					#recorded before the put, since the db thread may dequeue the page before this thread runs again
+					trace('queued')
 					self.db_queue.put((inst.soap,inst.opn,inst.el,inst.op,inst.page,response))
 				elif inst.soap == 'qu':					
 					#for a query we need to explicitly load the date range or other criteria because it's not embedded in the sync
 					if debug:
 						print('%s beginning work on %s %s page %s' % (self.name,inst.opn,inst.op,str(inst.page)))
 
-					response = self.session.query_fields(inst.el,inst.fields,inst.op,start_date=inst.startdate,end_date=inst.enddate,page=inst.page,querytype=inst.querytype,)
+					if inst.keypage is None:
+						response = self.session.query_fields(inst.el,inst.fields,inst.op,start_date=inst.startdate,end_date=inst.enddate,pagesize=pagelimits.get(inst.el,100),page=inst.page,querytype=inst.querytype,whereclause=inst.whereclause)
+					else:
+						response = self.session.query_fields(inst.el,inst.fields,inst.op,start_date=inst.startdate,end_date=inst.enddate,pagesize=pagelimits.get(inst.el,100),page=inst.keypage,querytype=inst.querytype,whereclause=inst.whereclause,keyset=True,after=inst.after)
+						self.parent.rawcount = response.rawcount
+						self.parent.lastkey = response.lastkey
+					if inst.watermark is not None:
+						self.parent.raise_watermark(response.max_value(inst.watermark))
 					results = response.list_results()
 					if len(results) == 0:
-						self.parent.blankpage = inst.page
+						if inst.keypage is None or response.rawcount == 0:
+							#pages may be downloaded out of order, so keep the first blank one
+							with self.parent.blank_lock:
+								if self.parent.blankpage is None or inst.page < self.parent.blankpage:
+									self.parent.blankpage = inst.page
 					else:
+						trace('queued')
 						self.db_queue.put((inst.soap,inst.opn,inst.el,inst.op,inst.page,response))
 				if debug:
 					print('downloaded page %s of %s %s results; success!' % (str(inst.page), inst.el, inst.op))
@@ -66,18 +105,34 @@ class DownloadThread(Thread):
 			except Exception as e:
 				self.db_queue.put((inst.soap,inst.opn,inst.el,inst.op,inst.page,'UNHANDLED EXCEPTION %s, %s' % (e.__class__.__name__, str(e).replace("'","''"))))
 				raise
+			trace_unit(None)
 			self.task_queue.task_done()
 			
 
 
 class Controller():
 	def __init__(self,):
-		self.session = SOAPSession()
+		#worker threads pair up on sessions, two to an account; the logins for all of them are done at once
+		accounts = [(soap_uname, soap_pw)]
+		for sessnum in range(2,floor((workerthreads - 1)/2) + 2):
+			accounts.append((settings['account' + str(sessnum)],settings['pw' + str(sessnum)]))
+		sessions = dict(zip(range(1,len(accounts) + 1),open_sessions(accounts)))
+		self.session = sessions[1]
+		self.sessions = [sessions[num] for num in sorted(sessions)]
 		self.db = None
 		self.sync = None
+		self.paths = {}
+		self.staged = {}
+		self.unmerged = 0
+		self.counts = {}
+		self.planned = None
+		self.windows_counted = None
 		self.threads = {}
 		self.task_queue = Queue()
 		self.db_queue = Queue()
+		self.highwater = None
+		self.highwater_lock = Lock()
+		self.blank_lock = Lock()
 		self.db_connect()
 		self.dbthread = DBThread(curs(),self.db_queue,start_date=None,end_date=None,name='db')
 		self.dbthread.start()
@@ -85,33 +140,284 @@ class Controller():
 		self.threads = {}
 		for i in range(workerthreads):
 			print('working on workerthread %s' % str(i))
-			sessions = {1:self.session}
-			sessnum = floor(i/2) + 1
-			try:
-				session = sessions[sessnum]
-			except KeyError:
-				session = SOAPSession(username=settings['account' + str(sessnum)],pw=settings['pw' + str(sessnum)])
-				sessions[sessnum] = session
-
+			session = sessions[floor(i/2) + 1]
 			self.threads[i] = DownloadThread(self,session,self.task_queue,self.db_queue,name='worker'+str(i))
 			self.threads[i].start()
 		
+	def enqueue(self,inst):
+		"""Puts a Download_Instructions unit on the task queue for the download threads."""
+		trace('enqueued',unit_key(inst.opn,inst.op,self.dbthread.start_date,inst.page))
+		self.task_queue.put(inst)
+		
 	def db_connect(self):
 		if self.db is None:
 			self.db = curs()
 		
-	def db_sync_by_days(self,syncstart,syncend,ops):
+	def db_sync_by_days(self,syncstart,syncend,ops,merge_batch=merge_batch,count_first=count_first,shared_fetch=shared_fetch):
+		"""Syncs every day between syncstart and syncend that has not yet been completed for each (opname, operation) pair in ops.
+		The work is run a day at a time (see plan_windows) so that each synchronization session is opened once and used by every op that needs it.
+		With merge_batch, completed days are left in their staging tables and merged merge_batch at a time (see db_sync_one),
+		and anything still staged is merged at the end of the run.
+		With count_first, each window's units are counted as its sync session is opened (see count_window), and progress and an ETA are reported
+		after each unit.
+		With shared_fetch, the ops of each day that come from the same element are downloaded together (see share_fetches)."""
 		self.db.execute('SELECT populate_days();')  #populate the days table up to the present date
 		self.db.execute('COMMIT;')
+		plan = self.plan_windows(syncstart,syncend,ops)
+		print('%s units to sync over %s windows' % (str(sum(len(day_ops) for (sync_day, day_ops) in plan)), str(len(plan))))
+		self.run_plan(plan,merge_batch=merge_batch,shared_fetch=shared_fetch,report=count_first,count=count_first)
+	
+	def run_plan(self,plan,merge_batch=merge_batch,shared_fetch=shared_fetch,report=False,count=False):
+		"""Syncs each unit of a plan from plan_windows in order, then merges anything left staged and closes the sync session.
+		With count, each window is counted with count_window before its units are synced, and report prints progress after each unit.
+		Returns a summary dictionary of the number of units attempted and completed and the records loaded."""
+		self.run_started = (time(), self.dbthread.rows)
+		if count:
+			(self.planned, self.windows_counted) = (0, [0, len(plan)])
+		else:
+			self.windows_counted = None
+		unmerged = self.unmerged
+		summary = {'units' : 0, 'completed' : 0, 'rows' : 0}
+		try:
+			for (sync_day, day_ops) in plan:
+				if count:
+					self.planned += self.count_window(sync_day,day_ops)
+					self.windows_counted[0] += 1
+				if shared_fetch:
+					fetches = self.share_fetches(day_ops)
+				else:
+					fetches = [(opn, op, ()) for (opn, op) in day_ops]
+				for (opn, op, fanout) in fetches:
+					print('trying to sync %s %s for %s' %(', '.join((opn,) + fanout), op, sync_day))
+					summary['units'] += 1 + len(fanout)
+					summary['completed'] += self.db_sync_one(opn,op,sync_day,sync_day,merge_batch=merge_batch,fanout=fanout)
+					if report:
+						self.report_progress()
+		finally:
+			self.merge_all()
+			self.end_sync()
+		#units counted as completed when they were staged, but whose merge then failed
+		summary['completed'] -= self.unmerged - unmerged
+		summary['rows'] = self.dbthread.rows - self.run_started[1]
+		return summary
+	
+	def db_sync_sharded(self,syncstart,syncend,ops,processes=shard_processes,merge_batch=merge_batch,count_first=count_first,shared_fetch=shared_fetch):
+		"""Runs db_sync_by_days across several processes, each with its own Controller, sessions and database connections.
+		The luminate partition only allows one synchronization session open at a time, so every unit that needs one stays with this process;
+		the days of query mode units are spread across the processes, balanced by their record counts when count_first is set and
+		by their number of units otherwise.  Each unit has its own staging table and merges take the loader's advisory lock, so processes
+		working on different days of the same opname don't collide, and sync_event remains the record of what has been completed.
+		Returns the summaries of all the shards added together."""
+		self.db.execute('SELECT populate_days();')  #populate the days table up to the present date
+		self.db.execute('COMMIT;')
+		plan = self.plan_windows(syncstart,syncend,ops)
+		if count_first:
+			self.planned = self.plan_counts(plan)
+		shards = self.shard_plan(plan,processes)
+		print('syncing %s units across %s processes' % (str(sum(len(day_ops) for (sync_day, day_ops) in plan)), str(len(shards))))
+		if len(shards) == 1:
+			summaries = [self.run_plan(shards[0],merge_batch=merge_batch,shared_fetch=shared_fetch)]
+		else:
+			#spawn rather than fork, since this process already has its download and database threads running
+			with get_context('spawn').Pool(len(shards) - 1) as pool:
+				results = [pool.apply_async(run_shard,(shard, self.counts, merge_batch, shared_fetch)) for shard in shards[1:]]
+				summaries = [self.run_plan(shards[0],merge_batch=merge_batch,shared_fetch=shared_fetch)]
+				summaries += [result.get() for result in results]
+		total = {}
+		for summary in summaries:
+			for (key, val) in summary.items():
+				total[key] = total.get(key,0) + val
+		print('%s of %s units completed, %s records loaded' % (str(total['completed']), str(total['units']), str(total['rows'])))
+		return total
+	
+	def shard_plan(self,plan,processes):
+		"""Splits a plan from plan_windows into a list of plans, one per process.  The first holds every unit that needs a synchronization
+		session; the query mode units of each day go to whichever shard has the least work so far."""
+		shards = [[] for i in range(max(processes,1))]
+		weights = [0] * len(shards)
+		for (sync_day, day_ops) in plan:
+			syncops = [opvals for opvals in day_ops if self.sync_path(*opvals)[1] == 'sync']
+			queryops = [opvals for opvals in day_ops if self.sync_path(*opvals)[1] == 'query']
+			if queryops:
+				i = weights.index(min(weights))
+				shards[i].append((sync_day, queryops))
+				weights[i] += sum(self.counts.get(opvals + (sync_day, sync_day),1) for opvals in queryops)
+			if syncops:
+				shards[0].append((sync_day, syncops))
+				weights[0] += sum(self.counts.get(opvals + (sync_day, sync_day),1) for opvals in syncops)
+		return shards[:1] + [shard for shard in shards[1:] if shard]
+	
+	def plan_windows(self,syncstart,syncend,ops):
+		"""Returns the pending work between syncstart and syncend as a list of (isodate, [(opname, operation), ...]) in date order.
+		Within each day the ops done by query come first and those needing a synchronization session follow together,
+		so a sync window is opened at most once and never reopened after another window has replaced it."""
+		pending = {}
 		for (opn, op) in ops:
 			self.db.execute("SELECT cd.past_date FROM convio_days cd WHERE cd.past_date BETWEEN '%s' AND '%s' AND NOT EXISTS (SELECT 'X' FROM sync_event e WHERE cd.past_date BETWEEN e.start_date AND e.end_date AND e.opname = '%s' AND e.operation = '%s' AND e.completed = 'Y')" % (syncstart, syncend, opn, op))
-			days_to_sync = [data_row[0] for data_row in self.db.fetchall()]
-			for sync_day in days_to_sync:
-				print('trying to sync %s %s for %s' %(opn, op, sync_day.isoformat()))
-				self.db_sync_one(opn,op,sync_day.isoformat(),sync_day.isoformat())
+			for data_row in self.db.fetchall():
+				pending.setdefault(data_row[0],[]).append((opn, op))
+		self.db.execute('COMMIT;')
+		plan = []
+		for sync_day in sorted(pending):
+			day_ops = sorted(pending[sync_day],key=lambda opvals: self.sync_path(*opvals)[1] == 'sync')
+			plan.append((sync_day.isoformat(), day_ops))
+		return plan
+	
+	def share_fetches(self,day_ops):
+		"""Groups a window's (opname, operation) pairs by the element and operation they download, for db_sync_one to fetch once and fan out.
+		Returns a list of (lead opname, operation, tuple of the other opnames) in the order the lead opnames appeared."""
+		groups = {}
+		fetches = []
+		for (opn, op) in day_ops:
+			(el, path) = self.sync_path(opn,op)
+			if (el, op, path) in groups:
+				groups[(el, op, path)].append(opn)
+			else:
+				groups[(el, op, path)] = [opn]
+				fetches.append((el, op, path))
+		return [(groups[key][0], key[1], tuple(groups[key][1:])) for key in fetches]
+	
+	def count_window(self,sync_day,day_ops):
+		"""Gathers the record count of each of a window's (opname, operation) pairs, opening the window's synchronization session to do so.
+		The counts are kept in self.counts, where sync_status and __query__ use them to size each unit's pages (query mode units then download
+		all their known pages at once rather than one at a time), and the window's ops are reordered largest first within the query and sync groups.
+		Elements that don't support incremental downloads can't be counted and are left out.  Returns the number of records counted."""
+		total = 0
+		for (opn, op) in day_ops:
+			el = self.sync_path(opn,op)[0]
+			if recordtypes[el].ops.get('GetIncremental' + op.capitalize() + 's') != 'true':
+				continue
+			self.start_sync(sync_day,sync_day)
+			count = self.session.getcount(el,op)
+			self.counts[(opn, op, sync_day, sync_day)] = count
+			total += count
+		day_ops.sort(key=lambda opvals: (self.sync_path(*opvals)[1] == 'sync', -self.counts.get(opvals + (sync_day, sync_day),0)))
+		return total
+	
+	def plan_counts(self,plan):
+		"""Counts every window of a plan from plan_windows before anything is downloaded (see count_window), for db_sync_sharded to balance
+		its shards with.  The windows are counted last to first, so that the synchronization session left open is the one the run starts with.
+		Returns the total number of records counted."""
+		return sum(self.count_window(sync_day,day_ops) for (sync_day, day_ops) in reversed(plan))
+	
+	def report_progress(self):
+		"""Prints the records loaded so far against the number counted for the run, with the throughput and an estimate of the time left.
+		While windows are still being counted as the run reaches them, the total is projected from the windows counted so far."""
+		(started, startrows) = self.run_started
+		done = self.dbthread.rows - startrows
+		elapsed = time() - started
+		rate = done / elapsed if elapsed > 0 else 0
+		planned = self.planned
+		if self.windows_counted is not None and 0 < self.windows_counted[0] < self.windows_counted[1]:
+			#windows are counted as the run reaches them, so scale up from the ones counted so far
+			planned = int(planned * self.windows_counted[1] / self.windows_counted[0])
+		if rate > 0 and planned:
+			eta = '%d:%02d' % divmod(int(max(planned - done,0) / rate / 60),60)
+		else:
+			eta = 'unknown'
+		print('%s of %s records loaded, %.1f records/s, ETA %s (h:mm)' % (str(done), str(planned), rate, eta))
+	
+	def sync_path(self,opn,op):
+		"""Returns a tuple of the Luminate element behind an opname and operation, and 'query' or 'sync' for how it is downloaded.
+		Querying is faster, so it is used wherever the element supports it."""
+		try:
+			return self.paths[(opn, op)]
+		except KeyError:
+			pass
+		self.db.execute("SELECT element FROM sync_ops WHERE opname = '%s' AND operation = '%s'" % (opn, op))
+		el = self.db.fetchone()[0]
+		self.db.execute('COMMIT;')
+		#find out what operations the SOAP interface supports for this element
+		validops = recordtypes[el].ops
+		if validops['Query'] == 'true' and opn not in dontquery:
+			path = 'query'
+		elif validops['GetIncremental' + op.capitalize() + 's'] == 'true':
+			path = 'sync'
+		else:
+			raise SOAPError('attempted operation with no compatible option on the SOAP interface')
+		self.paths[(opn, op)] = (el, path)
+		return (el, path)
+	
+	def db_sync_incremental(self,ops,overlap=watermark_overlap,since='2014-06-01'):
+		"""Incremental sync of each (opname, operation) pair in ops, pulling only records beyond the high watermark stored by the previous run.
+		Cheap enough to run every few minutes; see db_sync_watermark."""
+		for (opn, op) in ops:
+			self.db_sync_watermark(opn,op,overlap=overlap,since=since)
+	
+	def db_sync_watermark(self,opn,op,overlap=watermark_overlap,since='2014-06-01'):
+		"""Queries the records of one opname and operation whose time field (CreationDate, ModifyDate or the javascript style date for longdates elements)
+		falls at or after the stored watermark less overlap seconds, loads them, and advances the watermark to the largest value seen.
+		With no stored watermark the query starts at the isodate since.  Watermarks live in the sync_watermark table (opname, operation, watermark),
+		and are only advanced once every page has been loaded.  Only elements that support queries can be synced this way.
+		Runs are booked in sync_event/sync_progress under the operation watermark_<op> and the window from the watermark's day to today while
+		they run, so they never touch the rows of the day based syncs, and that row is removed afterwards."""
+		self.db.execute("SELECT element FROM sync_ops WHERE opname = '%s' AND operation = '%s'" % (opn, op))
+		el = self.db.fetchone()[0]
+		if recordtypes[el].ops['Query'] != 'true' or opn in dontquery:
+			print('cannot sync %s %s by watermark, %s does not support queries' % (opn, op, el))
+			return
+		try:
+			timefield = timefields[(el,op)]
+		except KeyError:
+			timefield = timefields[op]
+		self.db.execute("SELECT watermark FROM sync_watermark WHERE opname = '%s' AND operation = '%s'" % (opn, op))
+		stored = self.db.fetchone()
+		self.db.execute('COMMIT;')
+		if stored is None:
+			if el in longdates:
+				floor = str(int(isodate_to_jsdate(since)))
+			else:
+				floor = since + 'T00:00:00+0000'
+			syncstart = since
+		else:
+			(floor, syncstart) = watermark_floor(stored[0],overlap,longdate = el in longdates)
+		#a run whose watermark falls on today would otherwise share its sync_event key with today's day based sync
+		unitop = 'watermark_' + op
+		syncvals = (opn, unitop, syncstart, date.today().isoformat())
+		if debug:
+			print('syncing %s %s from watermark %s' % (opn, op, floor))
+		stage = stage_name(*syncvals)
+		create_stage(self.db,opn,stage)
+		self.db.execute("DELETE FROM sync_event e WHERE e.opname = '%s' AND e.operation = '%s' AND e.start_date = '%s' AND e.end_date = '%s'" % syncvals)
+		self.db.execute("DELETE FROM sync_progress p WHERE p.opname = '%s' AND p.operation = '%s' AND p.start_date = '%s' AND p.end_date = '%s'" % syncvals)
+		self.db.execute('COMMIT;')
+		self.dbthread.stages[opn] = stage
+		self.dbthread.start_date = syncvals[2]
+		self.dbthread.end_date = syncvals[3]
+		self.highwater = None
+		self.__query__(opn,el,unitop,syncstart=syncvals[2],syncend=syncvals[3],altwhere='WHERE %s >= %s' % (timefield, floor),watermark=timefield)
+		
+		self.db.execute("SELECT is_complete('%s','%s','%s','%s')" % syncvals )
+		complete = self.db.fetchone()[0]
+		self.db.execute('COMMIT;')
+		if complete:
+			self.load_stages(opn,op,[(syncvals, stage)],commit=False)
+			if self.highwater is not None and (stored is None or moment(self.highwater) > moment(stored[0])):
+				self.db.execute("UPDATE sync_watermark SET watermark = '%s' WHERE opname = '%s' AND operation = '%s'" % (self.highwater, opn, op))
+				if self.db.rowcount == 0:
+					self.db.execute("INSERT INTO sync_watermark (opname, operation, watermark) VALUES ('%s','%s','%s')" % (opn, op, self.highwater))
+			print('the watermark sync op succeeded')
+		else:
+			print ('the watermark sync op failed')
+			self.discard_stage(opn,stage)
+		self.db.execute("DELETE FROM sync_event e WHERE e.opname = '%s' AND e.operation = '%s' AND e.start_date = '%s' AND e.end_date = '%s'" % syncvals)
+		self.db.execute("DELETE FROM sync_progress p WHERE p.opname = '%s' AND p.operation = '%s' AND p.start_date = '%s' AND p.end_date = '%s'" % syncvals)
+		self.db.execute('COMMIT;')
+	
+	def raise_watermark(self,value):
+		"""Called by the download threads with the largest time field value on each page of a watermark sync."""
+		if value is None:
+			return
+		with self.highwater_lock:
+			if self.highwater is None or moment(value) > moment(self.highwater):
+				self.highwater = value
 	
 	def __get_fields__(self,opname, el):
-		self.db.execute("SELECT field, parent FROM luminate_fields WHERE opname = '%s';" % (opname,))
+		#opname may be a tuple of opnames sharing one download, in which case we want every field any of them needs
+		if type(opname) == tuple:
+			self.db.execute("SELECT DISTINCT field, parent FROM luminate_fields WHERE opname IN ('%s');" % "','".join(opname))
+		else:
+			self.db.execute("SELECT field, parent FROM luminate_fields WHERE opname = '%s';" % (opname,))
 		dlfields = [(res[0], res[1]) for res in self.db.fetchall()]	
 		self.db.execute('COMMIT;')
 		#this is commented out because I moved the sorting task into the data_structures.DataElement.prepsort function
@@ -129,24 +435,37 @@ class Controller():
 			i += 1				
 		return fields		
 		
-	def __sync__(self,opn, el, op, syncstart, syncend):
+	def __sync__(self,opn, el, op, syncstart, syncend, fanout=()):
 		(pages, complete) = self.sync_status(opn,el,op,syncstart,syncend)
 		if complete == 'N':
-			fields= self.__get_fields__(opn,el)
+			target = (opn,) + fanout if fanout else opn
+			fields= self.__get_fields__(target,el)
 				
 			for i in range(1,pages+1):
-				inst = Download_Instructions('dl',opn,el,op,fields,i)
-				self.task_queue.put(inst)
+				inst = Download_Instructions('dl',target,el,op,fields,i)
+				self.enqueue(inst)
 			self.task_queue.join()
 			self.db_queue.join()
-			self.db.execute("SELECT page FROM sync_progress WHERE opname = '%s' AND operation = '%s' AND start_date = '%s' AND end_date = '%s' AND status = 'H'" % (opn, op, syncstart, syncend))
-			for i in self.db.fetchall():
-				inst = Download_Instructions('dl',opn,el,op,fields,i)
-				self.task_queue.put(inst)
+			for (page, held) in self.held_pages((opn,) + fanout,op,syncstart,syncend):
+				self.enqueue(Download_Instructions('dl',held,el,op,fields,page))
 			self.task_queue.join()
 			self.db_queue.join()
 			
-	def __query__(self,opn, el, op, syncstart = None, syncend = None, altwhere = None):
+	def held_pages(self,targets,op,syncstart,syncend):
+		"""Returns the pages of a unit left with status 'H' in sync_progress by any of the opnames in targets, as a list of (page, opname) in page order,
+		where opname is the tuple of those that need the page again if there is more than one, so that the others don't load it twice."""
+		self.db.execute("SELECT page, opname FROM sync_progress WHERE opname IN ('%s') AND operation = '%s' AND start_date = '%s' AND end_date = '%s' AND status = 'H'" % ("','".join(targets), op, syncstart, syncend))
+		held = {}
+		for (page, opname) in self.db.fetchall():
+			held.setdefault(int(page),set()).add(opname)
+		self.db.execute('COMMIT;')
+		pages = []
+		for page in sorted(held):
+			opnames = tuple(opname for opname in targets if opname in held[page])
+			pages.append((page, opnames if len(opnames) > 1 else opnames[0]))
+		return pages
+		
+	def __query__(self,opn, el, op, syncstart = None, syncend = None, altwhere = None, watermark = None, fanout = ()):
 		self.blankpage = None
 		if syncstart is None:
 			(syncstart, syncend) = ('2014-06-01', date.today().isoformat())
@@ -159,72 +478,233 @@ class Controller():
 				self.db.execute("SELECT page FROM sync_progress WHERE opname = '%s' AND operation = '%s' AND start_date = '%s' AND end_date = '%s' AND status = 'C'" % (opn,op,syncstart,syncend))
 				completed = self.db.fetchall()
 				self.db.execute('COMMIT;')
-			self.db.execute("SELECT field, parent FROM luminate_fields WHERE opname = '%s';" % (opn,))
-			fields= self.__get_fields__(opn,el)
-			if syncstart is not None:
+			target = (opn,) + fanout if fanout else opn
+			fields= self.__get_fields__(target,el)
+			if watermark is not None and (None, watermark) not in fields:
+				#the watermark is read from the downloaded pages, whether or not the opname's loader wants the field
+				fields.append((None, watermark))
+			if altwhere is None:
 				type = 'time'
 			else:
 				type = 'other'
+			count = self.counts.pop((opn,op,syncstart,syncend),None)
+			if keyset and el in pks:
+				self.__keyset_query__(opn,el,op,fields,syncstart,syncend,type,altwhere,watermark,fanout,count)
+				return
+			completedpages = [int(rec[0]) for rec in completed]
 			page = 1
-			while True:
-				if page not in [int(rec[0]) for rec in completed]:
-					#if we pass 
-					inst = Download_Instructions('qu',opn,el,op,fields,page,querytype=type,startdate=syncstart,enddate=syncend)
-					self.task_queue.put(inst)
+			if count:
+				#the planner has counted this unit, so the pages we know about can all go out to the download threads at once
+				pages = ceil(count / pagelimits.get(el,100))
+				for page in range(1,pages + 1):
+					if page not in completedpages:
+						self.enqueue(Download_Instructions('qu',target,el,op,fields,page,querytype=type,startdate=syncstart,enddate=syncend,whereclause=altwhere,watermark=watermark))
+				self.task_queue.join()
+				page = pages + 1
+			#then go a page at a time until we find the end, in case records have arrived since the count
+			while self.blankpage is None:
+				if page not in completedpages:
+					inst = Download_Instructions('qu',target,el,op,fields,page,querytype=type,startdate=syncstart,enddate=syncend,whereclause=altwhere,watermark=watermark)
+					self.enqueue(inst)
 					self.task_queue.join()
-					if self.blankpage is None:
-						page += 1
-					else:
-						self.db.execute("UPDATE sync_event SET pages = %s WHERE opname = '%s' AND operation = '%s' AND start_date = '%s' AND end_date = '%s'" % (str(self.blankpage-1),opn, op, syncstart, syncend))
-						self.db.execute("COMMIT;")
-						break
-			self.db.execute("SELECT page FROM sync_progress WHERE opname = '%s' AND operation = '%s' AND start_date = '%s' AND end_date = '%s' AND status = 'H'" % (opn, op, syncstart, syncend))
-			try:
-				for i in self.db.fetchall():
-					self.task_queue.put('qu',opn,el,op,fields,('time',syncstart,syncend,i))
-			except ProgrammingError:
-				pass
+				page += 1
+			self.db.execute("UPDATE sync_event SET pages = %s WHERE opname = '%s' AND operation = '%s' AND start_date = '%s' AND end_date = '%s'" % (str(self.blankpage-1),opn, op, syncstart, syncend))
+			self.db.execute("COMMIT;")
+			for (page, held) in self.held_pages((opn,) + fanout,op,syncstart,syncend):
+				self.enqueue(Download_Instructions('qu',held,el,op,fields,page,querytype=type,startdate=syncstart,enddate=syncend,whereclause=altwhere,watermark=watermark))
 			self.task_queue.join()
 			self.db_queue.join()
+	
+	def __keyset_query__(self,opn,el,op,fields,syncstart,syncend,type,whereclause=None,watermark=None,fanout=(),count=None):
+		"""Query mode download that continues from the primary key of the last record seen rather than a page offset,
+		so deep pages cost the same as the first and records shifting between pages during the sync are neither skipped nor repeated.
+		Page numbers are still assigned in sequence for sync_progress, but a keyset run always starts over from the beginning of the window.
+		Each page has to wait for the key of the one before, so a count from the planner can't send pages out early; it is recorded in sync_event
+		as the expected number of pages until the real number is known."""
+		(after, keypage, page, retries) = (None, 1, 1, 0)
+		if count:
+			self.db.execute("UPDATE sync_event SET pages = %s WHERE opname = '%s' AND operation = '%s' AND start_date = '%s' AND end_date = '%s'" % (str(ceil(count / pagelimits.get(el,100))),opn, op, syncstart, syncend))
+			self.db.execute("COMMIT;")
+		while True:
+			(self.rawcount, self.lastkey) = (None, None)
+			inst = Download_Instructions('qu',(opn,) + fanout if fanout else opn,el,op,fields,page,querytype=type,startdate=syncstart,enddate=syncend,whereclause=whereclause,after=after,keypage=keypage,watermark=watermark)
+			self.enqueue(inst)
+			self.task_queue.join()
+			if self.blankpage is not None:
+				self.db.execute("UPDATE sync_event SET pages = %s WHERE opname = '%s' AND operation = '%s' AND start_date = '%s' AND end_date = '%s'" % (str(self.blankpage-1),opn, op, syncstart, syncend))
+				self.db.execute("COMMIT;")
+				break
+			elif self.rawcount is None:
+				#the download failed and the error went to the db thread; ask for the same key again
+				retries += 1
+				if retries > keyset_retries:
+					break
+			elif self.lastkey is None:
+				#every record on the page was at or before our key, so step over them with the page offset
+				keypage += 1
+			else:
+				(after, keypage, page, retries) = (self.lastkey, 1, page + 1, 0)
+		self.db_queue.join()
 		
-		
-	def db_sync_one(self,opn,op,syncstart,syncend):
-		self.db.execute("SELECT element FROM sync_ops WHERE opname = '%s' AND operation = '%s'" % (opn, op))
-		el = self.db.fetchone()[0]
+	def db_sync_one(self,opn,op,syncstart,syncend,merge_batch=0,fanout=()):
+		"""Syncs one opname and operation for one window, and merges the loaded records into the target tables with db_load.
+		The records are downloaded into an unlogged staging table of the unit's own (see database.stage_name), so that several windows of the
+		same opname can be synced at once, and only reach the shared loader table when they are merged.
+		With merge_batch, a completed unit is left staged and marked 'S' in sync_event, and merge is called once merge_batch units are staged.
+		fanout is a tuple of other opnames drawn from the same element and operation: the union of all their fields is downloaded once,
+		and each page is loaded into every one of them (see share_fetches).  sync_event and sync_progress are still kept per opname."""
+		(el, path) = self.sync_path(opn,op)
 		if debug:
 			print("syncing one, el is %s" % el)
-		syncvals = (opn, op, syncstart, syncend)
-		self.db.execute('DELETE FROM %s_loader;' % opn)
-		self.db.execute("DELETE FROM sync_event e WHERE e.opname = '%s' AND e.operation = '%s' AND e.start_date = '%s' AND e.end_date = '%s' AND e.completed = 'N'" % syncvals)
+		stages = {}
+		for unit_opn in (opn,) + fanout:
+			syncvals = (unit_opn, op, syncstart, syncend)
+			stages[unit_opn] = stage_name(*syncvals)
+			create_stage(self.db,unit_opn,stages[unit_opn])
+			self.db.execute("DELETE FROM sync_event e WHERE e.opname = '%s' AND e.operation = '%s' AND e.start_date = '%s' AND e.end_date = '%s' AND e.completed IN ('N','S')" % syncvals)
+			if unit_opn != opn:
+				#the lead opname's event is created as the download starts; the others follow its page count once it's done
+				self.db.execute("INSERT INTO sync_event (opname, operation, start_date, end_date) VALUES ('%s','%s','%s','%s')" % syncvals)
+			self.dbthread.stages[unit_opn] = stages[unit_opn]
+		self.db.execute('COMMIT;')
 		self.dbthread.start_date = syncstart
 		self.dbthread.end_date = syncend
-		#find out what operations the SOAP interface supports for this element
-		validops = recordtypes[el].ops
-		#querying is faster, so try that first
-		if validops['Query'] == 'true' and opn not in dontquery:
-			self.__query__(opn,el,op,syncstart=syncstart,syncend=syncend)
-		elif validops['GetIncremental' + op.capitalize() + 's'] == 'true':
-			self.__sync__(opn, el, op, syncstart, syncend)
-
+		if path == 'query':
+			self.__query__(opn,el,op,syncstart=syncstart,syncend=syncend,fanout=fanout)
 		else:
-			raise SOAPError('attempted operation with no compatible option on the SOAP interface')
-								
+			self.__sync__(opn, el, op, syncstart, syncend, fanout=fanout)
+		for unit_opn in fanout:
+			self.db.execute("UPDATE sync_event e SET pages = (SELECT l.pages FROM sync_event l WHERE l.opname = '%s' AND l.operation = '%s' AND l.start_date = '%s' AND l.end_date = '%s') WHERE e.opname = '%s' AND e.operation = '%s' AND e.start_date = '%s' AND e.end_date = '%s'" % (opn, op, syncstart, syncend, unit_opn, op, syncstart, syncend))
+		self.db.execute('COMMIT;')
+		completed = 0
+		for unit_opn in (opn,) + fanout:
+			if self.finish_unit((unit_opn, op, syncstart, syncend),stages[unit_opn],merge_batch):
+				completed += 1
+		return completed
+	
+	def finish_unit(self,syncvals,stage,merge_batch=0):
+		"""Checks whether a downloaded unit is complete, and merges it (or stages it for merging) if so, or throws it away if not.
+		Returns whether it was complete."""
+		(opn, op) = syncvals[:2]
 		self.db.execute("SELECT is_complete('%s','%s','%s','%s')" % syncvals )
 		complete = self.db.fetchone()[0]
 		self.db.execute('COMMIT;')
-		if complete:
-			print('the sync op succeeded')
-			self.db.execute("SELECT db_load('%s','%s')" % (opn,op))
-			self.db.execute("UPDATE sync_event e SET completed = 'Y' WHERE e.opname = '%s' AND e.operation = '%s' AND e.start_date = '%s' AND e.end_date = '%s'" % syncvals)
-			self.db.execute('COMMIT;')
+		if complete and merge_batch:
+			print('the sync op succeeded, staging for merge')
+			self.db.execute("UPDATE sync_event e SET completed = 'S' WHERE e.opname = '%s' AND e.operation = '%s' AND e.start_date = '%s' AND e.end_date = '%s'" % syncvals)
 			self.db.execute('COMMIT;')
+			self.staged.setdefault((opn, op),[]).append((syncvals, stage))
+			if len(self.staged[(opn, op)]) >= merge_batch:
+				self.merge(opn,op)
+		elif complete:
+			print('the sync op succeeded')
+			self.load_stages(opn,op,[(syncvals, stage)])
 		else:
 			print ('the sync op failed')
-			self.db.execute('DELETE FROM %s_loader;' % opn)
+			self.discard_stage(opn,stage)
 			self.db.execute("DELETE FROM sync_event e WHERE e.opname = '%s' AND e.operation = '%s' AND e.start_date = '%s' AND e.end_date = '%s'" % syncvals)
 			self.db.execute('COMMIT;')
+		return bool(complete)
+	
+	def load_stages(self,opn,op,units,commit=True):
+		"""Moves the records of a list of staged (syncvals, staging table) units into the opname's loader table, merges them with one db_load,
+		marks the units completed and drops their staging tables.  This all happens in one transaction holding the loader's advisory lock,
+		so the loader is never shared between two merges, and the loader is emptied with TRUNCATE, which leaves no dead rows to vacuum."""
+		loader_lock(self.db,opn)
+		self.db.execute('TRUNCATE %s_loader;' % opn)
+		for (syncvals, stage) in units:
+			self.db.execute('INSERT INTO %s_loader SELECT * FROM %s;' % (opn, stage))
+		self.db.execute("SELECT db_load('%s','%s')" % (opn,op))
+		for (syncvals, stage) in units:
+			self.db.execute("UPDATE sync_event e SET completed = 'Y' WHERE e.opname = '%s' AND e.operation = '%s' AND e.start_date = '%s' AND e.end_date = '%s'" % syncvals)
+			self.discard_stage(opn,stage)
+		self.db.execute('TRUNCATE %s_loader;' % opn)
+		if commit:
+			self.db.execute('COMMIT;')
+	
+	def discard_stage(self,opn,stage):
+		"""Drops a unit's staging table, and stops the db thread loading the opname into it if it still is."""
+		drop_stage(self.db,stage)
+		if self.dbthread.stages.get(opn) == stage:
+			del self.dbthread.stages[opn]
+	
+	def merge(self,opn,op):
+		"""Merges all the units of an opname and operation staged by db_sync_one.  The merge is one transaction, so if it fails none of its units
+		are marked completed: they are thrown away like a failed unit, to be synced again by the next run, and the other merges go ahead."""
+		units = self.staged.pop((opn, op))
+		print('merging %s staged units of %s %s' % (str(len(units)), opn, op))
+		try:
+			self.load_stages(opn,op,units)
+		except DatabaseError as d:
+			self.db.execute('ROLLBACK;')
+			print('merge of %s %s failed, %s units left to sync again: %s' % (opn, op, str(len(units)), str(d)))
+			for (syncvals, stage) in units:
+				self.discard_stage(opn,stage)
+				self.db.execute("DELETE FROM sync_event e WHERE e.opname = '%s' AND e.operation = '%s' AND e.start_date = '%s' AND e.end_date = '%s'" % syncvals)
+			self.db.execute('COMMIT;')
+			self.unmerged += len(units)
+	
+	def merge_all(self):
+		"""Merges everything that has units staged."""
+		for (opn, op) in list(self.staged):
+			self.merge(opn,op)
 				
-	def patch(self,opn):
+	def local_ids(self,opn,table=None):
+		"""Returns a RangeSet of the primary keys loaded for an opname, read from its target table (named after the opname unless table is given).
+		The keys are streamed in order through a server side cursor, so the set is built a run at a time without holding the keys themselves."""
+		self.db_connect()
+		(el, path) = self.sync_path(opn,'insert')
+		pk = pks[el]
+		if table is None:
+			table = opn
+		ids = RangeSet()
+		#psycopg2 doesn't see the COMMITs sent as statements, so it wouldn't open a transaction for the cursor's DECLARE on its own
+		self.db.execute('BEGIN;')
+		with self.db.connection.cursor(name='%s_ids' % opn.lower()) as idcurs:
+			idcurs.itersize = 100000
+			idcurs.execute('SELECT %s FROM %s WHERE %s IS NOT NULL ORDER BY %s' % (pk, table, pk, pk))
+			ids.update(rec[0] for rec in idcurs)
+		self.db.execute('COMMIT;')
+		return ids
+		
+	def remote_ids(self,el):
+		"""Returns a RangeSet of the primary keys Luminate reports for a data element, from a query asking for nothing but the key.
+		The query seeks past the last key of each page (see SOAPSession.query_fields) rather than paging by offset.
+		Each page has to wait for the last key of the one before, so this is one round trip for every pagelimits[el] keys, made one after another
+		on a single session: a million constituents at 200 a page is 5000 requests, which at the interface's usual second or two apiece is a
+		couple of hours.  It can't be shared out among the download threads the way a counted query is, so run it outside of a sync."""
+		pk = pks[el]
+		ids = RangeSet()
+		(after, page) = (None, 1)
+		while True:
+			r = self.session.query_fields(el,[(None,pk)],'insert',pagesize=pagelimits.get(el,100),page=page,querytype='other',whereclause='WHERE %s > 0' % pk,keyset=True,after=after)
+			if r.rawcount == 0:
+				break
+			ids.update(row[0] for row in r.list_results(header=[pk]) if row[0])
+			if r.lastkey is None:
+				page += 1
+			else:
+				(after, page) = (r.lastkey, 1)
+		return ids
+		
+	def find_gaps(self,opn,table=None,patch=False):
+		"""Compares the primary keys loaded for an opname with those Luminate has, returning a tuple of RangeSets (missing, deleted):
+		keys Luminate has that we don't, and keys we have that Luminate no longer does.  With patch=True they are passed straight to patch.
+		Our keys are read first, so a record created and synced while Luminate is being scanned can only show up as missing, never as deleted."""
+		self.db_connect()
+		(el, path) = self.sync_path(opn,'insert')
+		local = self.local_ids(opn,table)
+		remote = self.remote_ids(el)
+		(missing, deleted) = (remote - local, local - remote)
+		print('%s: %s ids in Luminate, %s loaded, %s missing, %s deleted' % (opn, str(len(remote)), str(len(local)), str(len(missing)), str(len(deleted))))
+		if patch:
+			self.patch(opn,ids=missing,deleted=deleted)
+		return (missing, deleted)
+		
+	def patch(self,opn,ids=None,deleted=None):
+		"""Re-downloads records by primary key, 100 at a time, and merges them with db_load.  The keys are taken from the unresolved rows of the
+		opname's _gaps table, unless ids is given as an iterable of keys (such as the missing RangeSet from find_gaps).
+		deleted is an iterable of keys Luminate no longer has, which are passed through the loader table to db_load as a delete."""
 		self.db_connect()
 		self.db.execute("SELECT element FROM sync_ops WHERE opname = '%s' AND operation = '%s'" % (opn, 'insert'))
 		el = self.db.fetchone()[0]
@@ -234,37 +714,43 @@ class Controller():
 		fieldstring = ', '.join(fields)
 		self.db.execute("COMMIT")
 		pk = pks[el]
+		if ids is not None:
+			idsource = iter(ids)
 		while True:
 			if debug:
 				print('running a patch job')
-			self.db.execute("SELECT %s FROM %s_gaps WHERE resolved = 'N' LIMIT 100" % (pk, opn))
-			ids = [rec[0] for rec in self.db.fetchall()]
-			if len(ids) == 0:
+			if ids is None:
+				self.db.execute("SELECT %s FROM %s_gaps WHERE resolved = 'N' LIMIT 100" % (pk, opn))
+				batch = [rec[0] for rec in self.db.fetchall()]
+			else:
+				batch = list(islice(idsource,100))
+			if len(batch) == 0:
 				break
 			idjoin = 'OR %s = ' % (pk,)
-			idstring = idjoin.join([str(id) for id in ids])
+			idstring = idjoin.join([str(id) for id in batch])
 			self.db.execute("COMMIT;")
 
 			qstring = "SELECT " + fieldstring + ' FROM ' + el + ' WHERE ' + pk + ' = ' + idstring
 			r = self.session.query(qstring)
 			self.db.execute("SELECT column_name FROM information_schema.columns WHERE table_name = '%s_loader' ORDER BY ordinal_position" % opn.lower())
 			header = [col[0] for col in self.db.fetchall()]
-			data = r.list_results(header=header)
 			self.db.execute('COMMIT;')
-			if opn[-3:] == 'Rel':
-				print('doing relation table fix')
-				olddata = data
-				data = []
-				for consrecord in olddata:
-					for grpid in consrecord[1]:
-						print('appending a row')
-						data.append([consrecord[0],grpid])
-			results = StringIO('\n'.join(['\t'.join(row) for row in data]))
+			results = RowStream(r.explode_results(el,header=header))
 			print('uploading')
+			loader_lock(self.db,opn)
 			self.db.copy_from(results,opn + '_loader',null='')
-			self.db.execute("UPDATE %s_gaps g SET resolved = 'Y' WHERE %s = %s" % (el, pk, idstring))
-			print('marking completed')
-			self.db.execute("SELECT db_load('%s','insert')" % (el,))
+			if ids is None:
+				self.db.execute("UPDATE %s_gaps g SET resolved = 'Y' WHERE %s = %s" % (opn, pk, idstring))
+				print('marking completed')
+			self.db.execute("SELECT db_load('%s','insert')" % (opn,))
+			self.db.execute("COMMIT;")
+		if deleted:
+			results = RowStream([str(id)] for id in deleted)
+			loader_lock(self.db,opn)
+			self.db.execute('TRUNCATE %s_loader;' % opn)
+			self.db.copy_from(results,opn + '_loader',null='',columns=(pk.lower(),))
+			self.db.execute("SELECT db_load('%s','delete')" % (opn,))
+			self.db.execute('TRUNCATE %s_loader;' % opn)
 			self.db.execute("COMMIT;")
 			
 #this was a concept that I toyed with but eventually abandoned for getting group memberships without creating a giant table.
@@ -303,24 +789,38 @@ class Controller():
 		status = self.db.fetchone()
 		self.db.execute('COMMIT;')
 		if status is None:
-			recordcount = self.session.getcount(el,op)
+			try:
+				recordcount = self.counts.pop((opn,op,start_date,end_date))
+			except KeyError:
+				recordcount = self.session.getcount(el,op)
 			pages = 1 + (recordcount - recordcount % pagelimits[el]) / pagelimits[el]
 			self.db.execute("INSERT INTO sync_event (opname, operation, start_date, end_date, pages) VALUES ('%s','%s','%s','%s',%s)" % (opn, op, start_date, end_date, str(pages)))
 			status = (opn, op, start_date, end_date, pages, 'N')
 		return (int(status[4]), status[5])
 		
 	def start_sync(self,start_date,end_date):
+		"""Opens a synchronization session for the window on every account's session, since the download threads on each of them
+		run the window's sync mode units.  Does nothing if that window is already open."""
 		if self.sync == (start_date,end_date):
 			return
-		try:
-			self.session.start_sync(start_date,end_date)
-		except SOAPError as e:
-			if e.faultcode == 'CLIENT':
-				self.session.end_sync()
-				self.session.start_sync(start_date,end_date)
-			else:
-				raise
+		for session in self.sessions:
+			try:
+				session.start_sync(start_date,end_date)
+			except SOAPError as e:
+				if e.faultcode == 'CLIENT':
+					session.end_sync()
+					session.start_sync(start_date,end_date)
+				else:
+					raise
 		self.sync = (start_date,end_date)
+	
+	def end_sync(self):
+		"""Closes the synchronization sessions opened by start_sync, if there are any."""
+		if self.sync is None:
+			return
+		for session in self.sessions:
+			session.end_sync()
+		self.sync = None
 		
 	def sync_from_folder(self,folder):
 		"""Designate a folder containing a guidefile containing instructions for download ops.
@@ -343,8 +843,15 @@ class Controller():
 
 
 
+def run_shard(plan,counts,merge_batch,shared_fetch):
+	"""Entry point of the worker processes started by Controller.db_sync_sharded: runs one shard of a plan on a Controller of its own."""
+	controller = Controller()
+	controller.counts = dict(counts)
+	return controller.run_plan(plan,merge_batch=merge_batch,shared_fetch=shared_fetch)
+
+
 class Download_Instructions():
-	def __init__(self,soap, opn, el, op,fields,page,startdate=None,enddate=None,querytype=None,whereclause=None):
+	def __init__(self,soap, opn, el, op,fields,page,startdate=None,enddate=None,querytype=None,whereclause=None,after=None,keypage=None,watermark=None):
 		self.soap = soap
 		self.opn = opn
 		self.el = el
@@ -355,4 +862,6 @@ class Download_Instructions():
 		self.whereclause = whereclause
 		self.startdate=startdate
 		self.enddate=enddate
-		
\ No newline at end of file
+		self.after=after
+		self.keypage=keypage
+		self.watermark=watermark
@@ -1,10 +1,34 @@
 from .local_settings import soap_path
 import pickle
+import dateutil.parser as dp
 
 field_params_std = ['Name','Writable','Custom','Nillable','Multiple','Type','MaxLength','IsCriterion','IsWildcard']
 
 
 
+def parse_bool(val):
+	return val.lower() == 'true'
+
+def parse_date(val):
+	return dp.parse(val).date()
+
+#converters from Luminate's xsd type names (lowercased, prefix dropped) to python types.  Anything not listed is left as a string.
+type_converters = {'int' : int, 'integer' : int, 'long' : int, 'short' : int, 'byte' : int,
+	'double' : float, 'float' : float, 'decimal' : float,
+	'boolean' : parse_bool, 'datetime' : dp.parse, 'date' : parse_date}
+
+def lookup_table(values,convert):
+	"""Builds a dictionary mapping each distinct non-empty value in values to convert(value), so that each distinct value is only converted once."""
+	table = {}
+	for val in values:
+		if type(val) == list:
+			for v in val:
+				if v != '' and v not in table:
+					table[v] = convert(v)
+		elif val != '' and val not in table:
+			table[val] = convert(val)
+	return table
+	
 def getname(field_obj):
 	if type(field_obj) == str:
 		return field_obj
@@ -38,6 +62,64 @@ class Data_Element():
 			else:
 				ret.append(parent + '.' + field)
 		return ret
+	
+	def find_field(self,name):
+		"""Returns the DataField object for a field name as it appears in downloaded records, looking through the record types of
+		complex fields if it is not a field of this element.  Returns None if the field is not found."""
+		field = field_named(self.fields,name)
+		if field is not None:
+			return field
+		for field in self.fields.values():
+			try:
+				child = recordtypes[field['Type']]
+			except KeyError:
+				continue
+			if child is not self and name in child.fields:
+				return child.fields[name]
+		return None
+	
+	def field_path(self,name):
+		"""Returns the DataField objects along a field name as it is downloaded: either a field of this element, or a Parent.Child path
+		to a field of a complex field's record type.  The list stops short at the first part of the path that can't be found."""
+		fields = self.fields
+		path = []
+		for part in name.split('.'):
+			field = field_named(fields,part)
+			if field is None:
+				break
+			path.append(field)
+			try:
+				fields = recordtypes[field['Type']].fields
+			except KeyError:
+				fields = {}
+		return path
+	
+	def field_at(self,name):
+		"""Returns the DataField object for a Parent.Child path, or for a bare field name as find_field does.  Returns None if the field is not found."""
+		if '.' not in name:
+			return self.find_field(name)
+		path = self.field_path(name)
+		if len(path) < len(name.split('.')):
+			return None
+		return path[-1]
+	
+	def is_multiple(self,name):
+		"""Returns True if a field can hold several values in one record.  name is the field as it is downloaded (see field_path),
+		and a Parent.Child path is multi-valued if any field along the path is marked Multiple."""
+		return any(field.characteristics.get('Multiple') == 'true' for field in self.field_path(name))
+	
+	def decode(self,header,columns,expand_codes=False):
+		"""Decodes a set of downloaded columns of this element into typed python values.
+		header is the list of field names or Parent.Child paths and columns a list of the matching lists of string values, as produced by SOAPResponse.columns.
+		Returns a dictionary of field name : decoded column.  See DataField.decode_column."""
+		decoded = {}
+		for (name, values) in zip(header,columns):
+			field = self.field_at(name)
+			if field is None:
+				decoded[name] = values
+			else:
+				decoded[name] = field.decode_column(values,expand_codes=expand_codes)
+		return decoded
 
 		
 class DataField():
@@ -63,6 +145,42 @@ class DataField():
 	def __getitem__(self,x):
 		return self.characteristics[x]
 	
+	def pytype(self):
+		"""Returns the lowercased type name of this field with any xsd: style prefix removed."""
+		try:
+			return self.characteristics['Type'].split(':')[-1].lower()
+		except KeyError:
+			return 'string'
+	
+	def decode_column(self,values,expand_codes=False):
+		"""Converts a whole column of downloaded string values to the python type given by the field's Type.
+		Each distinct value is converted once and the column is filled from that lookup table.  Empty values become None,
+		except for string fields, and multi-valued entries are decoded to lists.  A value that won't convert is printed and also
+		becomes None, so one bad value doesn't lose the whole column.
+		With expand_codes, coded fields are decoded to the names of their options instead."""
+		if self.is_coded and expand_codes:
+			convert = lambda val: self.codes.get(val,val)
+		else:
+			try:
+				convert = type_converters[self.pytype()]
+			except KeyError:
+				return values
+		table = lookup_table(values,lambda val: self.convert_value(convert,val))
+		decoded = []
+		for val in values:
+			if type(val) == list:
+				decoded.append([table.get(v) for v in val])
+			else:
+				decoded.append(table.get(val))
+		return decoded
+	
+	def convert_value(self,convert,val):
+		try:
+			return convert(val)
+		except (ValueError, TypeError, OverflowError):
+			print('could not convert %s value %s for field %s' % (self.pytype(), repr(val), self.characteristics.get('Name')))
+			return None
+	
 	def parse(self,val):
 		"""For luminate fields that use integers to encode string values, return the string value given the integer as an argument."""
 		if self.is_coded:
@@ -70,6 +188,16 @@ class DataField():
 		else:
 			return val
 		
+def field_named(fields,name):
+	"""Returns the DataField for name from a dictionary of fields, matching case-insensitively if there is no exact match, or None."""
+	if name in fields:
+		return fields[name]
+	lower = name.lower()
+	for fname in fields:
+		if fname.lower() == lower:
+			return fields[fname]
+	return None
+		
 def get_fieldsortkey(el_obj,fieldtuple):
 	"""function generates a sortkey that places fields in an order that the Luminate interface will permit, using 
 	information downloaded from Luminate about data structures."""
@@ -1,9 +1,11 @@
+import re
 import psycopg2
+from hashlib import md5
 from psycopg2 import OperationalError, DatabaseError, DataError, ProgrammingError
 from .local_settings import settings, debug
 from .soap_message import SOAPResponse
 from threading import Thread
-from io import StringIO
+from .tracing import trace, unit_key
 
 def conn():
 	return psycopg2.connect(user=settings['db_user'],password=settings['db_pw'],database=settings['db_name'],host=settings['db_host'])
@@ -14,6 +16,66 @@ def reconnect():
 def curs():
 	return conn().cursor()
 
+def stage_name(opn,op,start_date,end_date):
+	"""Returns the name of the staging table for one unit of a sync: an opname and operation over one window.
+	The whole operation goes into the name, since several share a prefix (watermark_insert and watermark_update); names past
+	the 63 character limit on Postgres identifiers are cut short and end in a hash of the full name so they stay distinct."""
+	name = re.sub('[^a-z0-9_]','_',('%s_stage_%s_%s_%s' % (opn, op, start_date.replace('-',''), end_date.replace('-',''))).lower())
+	if len(name) > 63:
+		name = name[:54] + '_' + md5(name.encode('utf-8')).hexdigest()[:8]
+	return name
+
+def create_stage(db,opn,stage):
+	"""(Re)creates an empty unlogged staging table with the columns of the opname's loader table.
+	Staging tables skip the WAL and are dropped once merged, so a crash only costs the units that were staged at the time."""
+	db.execute('DROP TABLE IF EXISTS %s;' % stage)
+	db.execute('CREATE UNLOGGED TABLE %s (LIKE %s_loader INCLUDING DEFAULTS);' % (stage, opn))
+	
+def drop_stage(db,stage):
+	db.execute('DROP TABLE IF EXISTS %s;' % stage)
+
+def loader_lock(db,opn):
+	"""Takes the transaction level advisory lock that serializes use of an opname's shared loader table across connections and processes."""
+	db.execute("SELECT pg_advisory_xact_lock(hashtext('%s_loader'));" % opn.lower())
+
+class RowStream():
+	"""Read-only file-like object presenting an iterable of rows as tab separated lines for copy_from.
+	Rows are formatted only as copy_from reads them, so a large page is never held in memory as a whole.  .rows counts the rows read so far."""
+	def __init__(self,rows):
+		self.rowiter = iter(rows)
+		self.buffer = ''
+		self.rows = 0
+
+	def read(self,size=-1):
+		chunks = [self.buffer]
+		length = len(self.buffer)
+		while size < 0 or length < size:
+			try:
+				row = next(self.rowiter)
+			except StopIteration:
+				break
+			line = '\t'.join(row) + '\n'
+			chunks.append(line)
+			length += len(line)
+			self.rows += 1
+		data = ''.join(chunks)
+		if size < 0:
+			self.buffer = ''
+			return data
+		self.buffer = data[size:]
+		return data[:size]
+
+	def readline(self,size=-1):
+		#copy_from only uses read, but this keeps the object usable as a file
+		while '\n' not in self.buffer:
+			try:
+				row = next(self.rowiter)
+			except StopIteration:
+				break
+			self.buffer += '\t'.join(row) + '\n'
+			self.rows += 1
+		(line, sep, self.buffer) = self.buffer.partition('\n')
+		return line + sep
 
 			
 class DBThread(Thread):
@@ -24,6 +86,8 @@ class DBThread(Thread):
 		self.db_queue = db_queue
 		self.start_date = start_date
 		self.end_date = end_date
+		self.stages = {}
+		self.rows = 0
 		self.headers = {}
 		print('DBThread Initiated')
 		
@@ -31,65 +95,78 @@ class DBThread(Thread):
 		print('dbthread running')
 		while True:
 			(soap,opn,el,op,page,response) = self.db_queue.get()
-			if debug:
-				print('dbthread working on page %s of %s %s' % (str(page),opn, op))
-			try:
-				assert type(response) == SOAPResponse
-				try:
-					header = self.headers[opn]
-				except KeyError:
-					self.db.execute("SELECT column_name FROM information_schema.columns WHERE table_name = '%s_loader' ORDER BY ordinal_position" % opn.lower())
-					header = [col[0] for col in self.db.fetchall()]
-					self.db.execute('commit;')
-					self.headers[opn] = header
-				data = response.list_results(header=header)
-				#in all cases except constituent group relationships the data that's coming across is ready to be written to the db.
-				#For cons/group relationships we need to split each row into multiple rows of consid - groupid
-				if debug:
-					print('dbthread working on %s results' % str(len(data)))
-				if opn == 'ConsGroupRel':
-					olddata = data
-					data = []
-					for consrecord in olddata:
-						for grpid in consrecord[1]:
-							data.append([consrecord[0],grpid])
-				results = StringIO('\n'.join(['\t'.join(row) for row in data]))
-				try:
-					self.db.copy_from(results,opn + '_loader',null='')
-					self.progress_insert((opn,op,page),'C')
-				except DatabaseError as d:
-					self.db = curs()
-					print('database error %s' % str(d))
-					results = StringIO('\n'.join(['\t'.join(row) for row in data]))
-					self.db.copy_from(results,opn + '_loader',null='')
-					self.progress_insert((opn,op,page),'C')
-				except OperationalError:
-					self.db = curs()
-					self.db_queue.put((opn, el, op, page, data))
-					self.progress_insert((opn,op,page),'C')
-				except:
-					self.db.execute('rollback;')
-					self.progress_insert((opn,op,page),'D')
-					raise
-			except AssertionError:
-				try:
-					self.db.execute("INSERT INTO sync_errors (opname, operation, start_date, end_Date, page, error_message, event_time) VALUES ('%s','%s','%s','%s',%s,'%s',current_timestamp);" % (opn, op, self.start_date, self.end_date, str(page), response))
-					self.db.execute('COMMIT;')
-					if response == 'HTTP ERROR':
-						errcode = 'E'
-					else:
-						errcode = 'U'
-					self.progress_insert((opn,op,page),errcode)
-				except OperationalError:
-					self.db_queue.put((opn, el, op, page, data))
-					self.db = curs()
-				except ProgrammingError:
-					print('actual response type was %s' % str(type(response)))
+			#a page downloaded once for several opnames (see Controller.share_fetches and Controller.db_sync_one) is loaded into each of them in turn
+			if type(opn) == tuple:
+				targets = opn
+			else:
+				targets = (opn,)
+			#traced under the same unit as the download, so the two can be joined up for a shared page too
+			unit = unit_key(opn,op,self.start_date,page)
+			for target in targets:
+				self.load_page(target,el,op,page,response,unit)
 			self.db_queue.task_done()
 			if debug:
 				print('dbthread task done')
 					
-	def progress_insert(self,records,code):
+	def load_page(self,opn,el,op,page,response,unit=None):
+		"""Copies the records an opname's loader table asks for out of one downloaded page, into the opname's staging table (or its loader
+		table if no staging table has been set), and records the page's progress.  unit is the trace unit of the download, if it isn't the opname's own."""
+		if unit is None:
+			unit = unit_key(opn,op,self.start_date,page)
+		trace('db_dequeued',unit)
+		if debug:
+			print('dbthread working on page %s of %s %s' % (str(page),opn, op))
+		try:
+			assert type(response) == SOAPResponse
+			try:
+				header = self.headers[opn]
+			except KeyError:
+				self.db.execute("SELECT column_name FROM information_schema.columns WHERE table_name = '%s_loader' ORDER BY ordinal_position" % opn.lower())
+				header = [col[0] for col in self.db.fetchall()]
+				self.db.execute('commit;')
+				self.headers[opn] = header
+			#for relation-style opnames (a key and a multi-valued field, like ConsGroupRel) each value becomes a row of its own as the page is copied
+			results = RowStream(response.explode_results(el,header=header))
+			try:
+				self.db.copy_from(results,self.stages.get(opn,opn + '_loader'),null='')
+				trace('copied',unit)
+				self.rows += results.rows
+				if debug:
+					print('dbthread copied %s rows' % str(results.rows))
+				self.progress_insert((opn,op,page),'C',unit)
+			except DatabaseError as d:
+				self.db = curs()
+				print('database error %s' % str(d))
+				results = RowStream(response.explode_results(el,header=header))
+				self.db.copy_from(results,self.stages.get(opn,opn + '_loader'),null='')
+				trace('copied',unit)
+				self.rows += results.rows
+				self.progress_insert((opn,op,page),'C',unit)
+			except OperationalError:
+				self.db = curs()
+				self.db_queue.put((None, opn, el, op, page, response))
+				self.progress_insert((opn,op,page),'C',unit)
+			except:
+				self.db.execute('rollback;')
+				self.progress_insert((opn,op,page),'D',unit)
+				raise
+		except AssertionError:
+			try:
+				self.db.execute("INSERT INTO sync_errors (opname, operation, start_date, end_Date, page, error_message, event_time) VALUES ('%s','%s','%s','%s',%s,'%s',current_timestamp);" % (opn, op, self.start_date, self.end_date, str(page), response))
+				self.db.execute('COMMIT;')
+				if response == 'HTTP ERROR':
+					errcode = 'E'
+				else:
+					errcode = 'U'
+				self.progress_insert((opn,op,page),errcode,unit)
+			except OperationalError:
+				self.db_queue.put((opn, el, op, page, data))
+				self.db = curs()
+			except ProgrammingError:
+				print('actual response type was %s' % str(type(response)))
+					
+	def progress_insert(self,records,code,unit=None):
 		(opn, op, page) = (records[0], records[1], str(records[2]))
 		self.db.execute("SELECT sync_progress_update('%s','%s','%s','%s',%s,'%s');" % (opn, op, self.start_date, self.end_date, page, code))
-		self.db.execute('COMMIT;')
\ No newline at end of file
+		self.db.execute('COMMIT;')
+		trace('committed',unit if unit is not None else unit_key(opn,op,self.start_date,page),status=code)
\ No newline at end of file
@@ -0,0 +1,94 @@
+#columnar export of downloaded records to Arrow or Parquet files, for analytics jobs that would otherwise scan CSV exports repeatedly
+#pyarrow is only needed if these sinks are actually used
+
+from .exceptions import SOAPClientError
+from .data_structures import recordtypes
+try:
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+except ImportError:
+	pa = None
+
+#arrow types for the python types produced by DataField.decode_column
+arrow_types = {'int' : 'int64', 'integer' : 'int64', 'long' : 'int64', 'short' : 'int64', 'byte' : 'int64',
+	'double' : 'float64', 'float' : 'float64', 'decimal' : 'float64',
+	'boolean' : 'bool_', 'datetime' : 'timestamp', 'date' : 'date32'}
+
+
+def arrow_type(field,expand_codes=False,multiple=False):
+	"""Returns the arrow type for a DataField object, given whether coded values are being expanded to their option names
+	and whether the field is multi-valued (see Data_Element.is_multiple), in which case it is a list of its values' type."""
+	if field is None or (field.is_coded and expand_codes):
+		at = pa.string()
+	else:
+		try:
+			typename = arrow_types[field.pytype()]
+		except KeyError:
+			at = pa.string()
+		else:
+			if typename == 'timestamp':
+				at = pa.timestamp('ms',tz='UTC')
+			else:
+				at = getattr(pa,typename)()
+	if multiple:
+		at = pa.list_(at)
+	return at
+
+
+class ColumnarSink():
+	"""Writes SOAP responses for one data element to an Arrow IPC file or a Parquet file, one column per requested field.
+	The schema is fixed up front from the Luminate description of the element, so it does not drift from page to page the way results_header can.
+	Pages are buffered until rowgroup rows have accumulated and then written out as a single record batch / row group, which keeps memory bounded.
+	fields are (parent, field) tuples as passed to SOAPSession.download, and each becomes a column named Parent.Child (or just the field name
+	for a field of the element itself); format is 'parquet' or 'arrow'."""
+	def __init__(self,destfilename,data_element,fields,format='parquet',expand_codes=False,rowgroup=50000):
+		if pa is None:
+			raise SOAPClientError('pyarrow is required for columnar exports')
+		if format not in ('parquet','arrow'):
+			raise SOAPClientError('Unknown columnar export format %s' % format)
+		self.data_element = data_element
+		self.expand_codes = expand_codes
+		self.rowgroup = rowgroup
+		el_obj = recordtypes[data_element]
+		self.header = []
+		schemafields = []
+		#columns are named by their full Parent.Child path, since fields of different complex fields can share a name
+		for name in el_obj.prepsort(list(fields)):
+			self.header.append(name)
+			schemafields.append(pa.field(name,arrow_type(el_obj.field_at(name),expand_codes,el_obj.is_multiple(name))))
+		self.schema = pa.schema(schemafields)
+		if format == 'parquet':
+			self.writer = pq.ParquetWriter(destfilename,self.schema)
+		else:
+			self.writer = pa.ipc.new_file(destfilename,self.schema)
+		self.format = format
+		self.buffer = []
+		self.buffered = 0
+		self.rows = 0
+
+	def write(self,response):
+		"""Decodes a SOAPResponse into typed columns and adds them to the buffer, flushing a row group once it is large enough."""
+		columns = response.typed_columns(self.data_element,header=list(self.header),expand_codes=self.expand_codes)
+		batch = pa.record_batch([pa.array(columns[name],type=self.schema.field(name).type) for name in self.header],schema=self.schema)
+		self.buffer.append(batch)
+		self.buffered += batch.num_rows
+		if self.buffered >= self.rowgroup:
+			self.flush()
+
+	def flush(self):
+		"""Writes out whatever has been buffered as one row group."""
+		if self.buffered == 0:
+			return
+		table = pa.Table.from_batches(self.buffer,schema=self.schema)
+		if self.format == 'parquet':
+			self.writer.write_table(table,row_group_size=self.buffered)
+		else:
+			for batch in table.combine_chunks().to_batches():
+				self.writer.write_batch(batch)
+		self.rows += self.buffered
+		self.buffer = []
+		self.buffered = 0
+
+	def close(self):
+		self.flush()
+		self.writer.close()
@@ -0,0 +1,95 @@
+#compact sets of integer ids held as sorted runs of consecutive values, for comparing the primary keys we hold against those Luminate reports
+#ids from Luminate are largely sequential, so a few million of them usually collapse into a few thousand runs
+
+
+class RangeSet():
+	"""A set of integers stored as a sorted list of non-overlapping, non-adjacent [start, end] runs (both ends inclusive).
+	Ids can be added in any order, but adding them in ascending order is cheapest: each one just extends or follows the last run."""
+	def __init__(self,ids=()):
+		self.ranges = []
+		self.update(ids)
+
+	@classmethod
+	def from_ranges(cls,ranges):
+		rs = cls()
+		for (start, end) in ranges:
+			rs._append(start,end)
+		return rs
+
+	def _append(self,start,end):
+		"""Adds a run that starts at or after the start of the last run."""
+		if self.ranges and start <= self.ranges[-1][1] + 1:
+			if end > self.ranges[-1][1]:
+				self.ranges[-1][1] = end
+		else:
+			self.ranges.append([start,end])
+
+	def add(self,id):
+		self.update((id,))
+
+	def update(self,ids):
+		"""Adds an iterable of ids to the set."""
+		pending = []
+		for id in ids:
+			id = int(id)
+			if pending or (self.ranges and id < self.ranges[-1][0]):
+				pending.append(id)
+			else:
+				self._append(id,id)
+		if pending:
+			#out of order ids are sorted and merged with what we have in one pass
+			pending.sort()
+			merged = RangeSet.from_ranges(_merge(self.ranges,[[id, id] for id in pending]))
+			self.ranges = merged.ranges
+
+	def __len__(self):
+		return sum(end - start + 1 for (start, end) in self.ranges)
+
+	def __iter__(self):
+		for (start, end) in self.ranges:
+			for id in range(start,end + 1):
+				yield id
+
+	def __contains__(self,id):
+		(lo, hi) = (0, len(self.ranges))
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if self.ranges[mid][1] < id:
+				lo = mid + 1
+			else:
+				hi = mid
+		return lo < len(self.ranges) and self.ranges[lo][0] <= id
+
+	def __sub__(self,other):
+		"""Returns the ids in this set that are not in other, working run by run."""
+		result = RangeSet()
+		theirs = other.ranges
+		j = 0
+		for (start, end) in self.ranges:
+			while j < len(theirs) and theirs[j][1] < start:
+				j += 1
+			k = j
+			while start <= end:
+				if k >= len(theirs) or theirs[k][0] > end:
+					result._append(start,end)
+					break
+				if theirs[k][0] > start:
+					result._append(start,theirs[k][0] - 1)
+				start = theirs[k][1] + 1
+				k += 1
+		return result
+
+	def __repr__(self):
+		return 'RangeSet(%s ids in %s runs)' % (str(len(self)), str(len(self.ranges)))
+
+
+def _merge(a,b):
+	"""Yields the runs of two sorted run lists in order of their starts."""
+	(i, j) = (0, 0)
+	while i < len(a) or j < len(b):
+		if j >= len(b) or (i < len(a) and a[i][0] <= b[j][0]):
+			yield a[i]
+			i += 1
+		else:
+			yield b[j]
+			j += 1
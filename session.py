@@ -6,9 +6,48 @@ from .utilities import element,  isodate_to_jsdate
 from .interface_data import recordtypes as ifdrec
 from .data_structures import Data_Element, DataField, recordtypes
 import pickle
-from threading import Lock
+import csv
+from os import remove, replace, truncate, fstat
+from os.path import isfile
+from threading import Lock, get_ident
+from concurrent.futures import ThreadPoolExecutor
+from time import time
 timefields = {'insert' : 'CreationDate', 'update': 'ModifyDate', ('ActionAlertResponse','insert') : 'SubmitDate',('GroupType','insert') : None}
 
+#session ids are kept on disk for this many seconds after login so that short runs can skip logging in; 0 turns this off
+token_ttl = settings.get('session_token_ttl',1800)
+token_lock = Lock()
+
+def load_token(username):
+	"""Returns the saved session id for username if there is one that has not expired, otherwise None."""
+	if not token_ttl:
+		return None
+	try:
+		with open(soap_path + 'session_tokens.pk3','rb') as tokenfile:
+			tokens = pickle.load(tokenfile)
+	except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+		return None
+	(token, expiry) = tokens.get(username,(None,0))
+	if expiry > time():
+		return token
+	return None
+	
+def save_token(username,token):
+	"""Saves the session id for username to disk along with its expiry time."""
+	if not token_ttl:
+		return
+	with token_lock:
+		try:
+			with open(soap_path + 'session_tokens.pk3','rb') as tokenfile:
+				tokens = pickle.load(tokenfile)
+		except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+			tokens = {}
+		tokens[username] = (token, time() + token_ttl)
+		#write to a temporary file and rename it into place, since other processes may be reading the file
+		tmpname = soap_path + 'session_tokens.pk3.%s.tmp' % str(get_ident())
+		with open(tmpname,'wb') as tokenfile:
+			pickle.dump(tokens,tokenfile,protocol=3)
+		replace(tmpname,soap_path + 'session_tokens.pk3')
 
 
 class SOAPSession():
@@ -17,9 +56,13 @@ class SOAPSession():
 	write_initialized = False
 	def __init__(self,username=soap_uname,pw=soap_pw):
 		self.lock = Lock()
+		self.login_lock = Lock()
 		self.username = username
 		self.pw = pw
-		self.login()
+		#a saved session id is only checked when it is first used; if it has expired the SESSION fault from the interface triggers a fresh login
+		self.session = load_token(username)
+		if self.session is None:
+			self.login()
 		
 	def login(self,username=None,pw=None):
 		"""Login with a username and password.  In general the class will instantiate with the username and password
@@ -30,15 +73,34 @@ class SOAPSession():
 			pw = self.pw
 		sr = SOAPLogin(username,pw,parent=self)
 		self.session = sr.session
+		save_token(username,self.session)
+	
+	def relogin(self,stale):
+		"""Logs in again after a request was refused with the session id stale, unless another thread sharing this session already has.
+		Returns the session id to retry with.  Held under its own lock, since queries don't take the session lock."""
+		with self.login_lock:
+			if self.session == stale:
+				self.login()
+			return self.session
 	
-	def query(self,querytext,pagesize=100,page=1):
-		"""Deliver a SQL query to Luminate and return the SOAP Response object returned.  Takes the query text as input."""
-		qr = SOAPQuery(self.session,querytext,pagesize=pagesize,page=page)
+	def query(self,querytext,pagesize=100,page=1,window=None):
+		"""Deliver a SQL query to Luminate and return the SOAP Response object returned.  Takes the query text as input.
+		window is the (start, end) isodates the query is bounded to, if any, which lets the response cache replay it once the window has ended."""
+		qr = SOAPQuery(self.session,querytext,parent=self,pagesize=pagesize,page=page,window=window)
 		return qr.response
 	
-	def query_fields(self,data_element,fields,op,start_date=None,end_date=None,pagesize=100,page=1,querytype='time',whereclause=None):
-		"""Do a query type download, taking the parameters of the download instead of the query text as the inputs."""
+	def query_fields(self,data_element,fields,op,start_date=None,end_date=None,pagesize=100,page=1,querytype='time',whereclause=None,keyset=False,after=None):
+		"""Do a query type download, taking the parameters of the download instead of the query text as the inputs.
+		With keyset=True the results are ordered by the primary key instead, and after may be passed as the primary key of the last record
+		already seen; the query then seeks past that key rather than relying on the page offset."""
 		r = recordtypes[data_element]
+		if keyset:
+			try:
+				pk = pks[data_element]
+			except KeyError:
+				raise SOAPClientError('No primary key known for keyset pagination of %s' % data_element)
+			if (None,pk) not in fields:
+				fields = fields + [(None,pk)]
 		#the fields have been passed as a list of tuples (parent, child), where parent may be None.  We need to assign proper ordering and
 		#sort them into the only order that the interface will recognize
 		fields = r.prepsort(fields)
@@ -53,6 +115,13 @@ class SOAPSession():
 		except KeyError:
 			#otherwise just sort by the first field.  Only matters that we're consistent.
 			sortfield = fields[0]
+		ordering = sortfield
+		seek = ''
+		if keyset:
+			#seek on the primary key alone: it is a unique integer, so there are no ties to break and no string collation to match
+			ordering = pk
+			if after is not None:
+				seek = ' AND %s > %s' % (pk, str(after))
 		#for most queries the WHERE clause will consist of a time window from which we are getting records
 		if querytype == 'time':
 			try:
@@ -61,24 +130,31 @@ class SOAPSession():
 				timefield = timefields[op]
 			#almost all timefields are stored as isodates, but one is a javascript style long integer
 			if data_element not in longdates:
-				qstring += " WHERE %s >= %sT00:00:00+0000 AND %s <= %sT23:59:59+0000 ORDER BY %s" % (timefield, start_date, timefield, end_date, sortfield)
+				qstring += " WHERE %s >= %sT00:00:00+0000 AND %s <= %sT23:59:59+0000%s ORDER BY %s" % (timefield, start_date, timefield, end_date, seek, ordering)
 			else:
-				qstring += " WHERE %s >= %s AND %s <= %s ORDER BY %s" % (timefield, str(isodate_to_jsdate(start_date)), timefield, str(isodate_to_jsdate(end_date)), sortfield)
+				qstring += " WHERE %s >= %s AND %s <= %s%s ORDER BY %s" % (timefield, str(isodate_to_jsdate(start_date)), timefield, str(isodate_to_jsdate(end_date)), seek, ordering)
 		elif querytype == 'other':
 			#if the query type is "other" we just use the WHERE clause passed in the function call
-			qstring += ' ' + whereclause + ' ORDER BY %s' % sortfield
+			qstring += ' ' + whereclause + seek + ' ORDER BY %s' % ordering
 		
 		if debug:
 			print(qstring)
-		return self.query(qstring,pagesize=pagesize,page=page)
+		if querytype == 'time':
+			window = (start_date, end_date)
+		else:
+			window = None
+		response = self.query(qstring,pagesize=pagesize,page=page,window=window)
+		if keyset:
+			response.seek(pk,after)
+		return response
 		
 		
 	def find(self):
 		pass
 		
-	def request(self):
-		"""Create a new SOAP Request object as part of this session."""
-		return SOAPRequest(session=self.session,parent=self)
+	def request(self,locked=True):
+		"""Create a new SOAP Request object as part of this session.  With locked=False the request is sent without taking the session lock."""
+		return SOAPRequest(session=self.session,parent=self,locked=locked)
 		
 	def start_sync(self,startdate,enddate):
 		"""Starts a synchronization session with the SOAP API.
@@ -91,6 +167,7 @@ class SOAPSession():
 		sr.submit()
 		
 		self.syncid = sr.response.tree.find('.//SyncId').text
+		self.syncwindow = (startdate, enddate)
 	
 	def end_sync(self):
 		"""Terminates a synchronization session"""
@@ -100,7 +177,7 @@ class SOAPSession():
 		
 		sr.submit()
 		
-		SyncID = None
+		self.syncid = None
 		
 	def _sync_op_checks(self,data_element,operation):
 		"""Checks that a sync is active and that the operation requested is valid for the Record type in question before performing an operation."""
@@ -153,30 +230,95 @@ class SOAPSession():
 		del self.writer
 		self.write_open = False
 	
-	def download_all(self,data_element,fields,dltype,destfilename):
+	def download_all(self,data_element,fields,dltype,destfilename,workers=1,resume=False):
+		"""Downloads every record of the current sync session to a CSV file, in pages of the size allowed for the element by pagelimits.
+		With workers > 1, pages are fetched concurrently but still written strictly in page order, holding no more than 2 * workers pages in memory.
+		The last page fully written and the length of the file after it are recorded in destfilename + '.progress'; resume=True cuts an interrupted file
+		back to that length, dropping any part of a page written after it, and appends from the page after it."""
+		pagesize = pagelimits.get(data_element,100)
+		recordcount = self.getcount(data_element,dltype)
+		lastpage = (recordcount + pagesize - 1) // pagesize
+		progressname = destfilename + '.progress'
+		dlpage = 1
+		if resume and isfile(progressname):
+			with open(progressname,'rb') as progressfile:
+				(written, offset) = pickle.load(progressfile)
+			truncate(destfilename,offset)
+			dlpage = written + 1
+			self._append_writefile(destfilename)
+		else:
+			self._prep_writefile(destfilename)
+		try:
+			if workers > 1:
+				self._download_ordered(data_element,fields,dltype,pagesize,dlpage,lastpage,workers,progressname)
+			else:
+				while dlpage <= lastpage:
+					self.dl_write(data_element,fields,dltype,pagesize=pagesize,page=dlpage)
+					self._mark_written(progressname,dlpage)
+					dlpage += 1
+		finally:
+			self._close_writefile()
+		if isfile(progressname):
+			remove(progressname)
+	
+	def _download_ordered(self,data_element,fields,dltype,pagesize,firstpage,lastpage,workers,progressname):
+		"""Fetches pages firstpage through lastpage on a pool of workers threads and writes them out in page order.
+		Pages that arrive early wait in a reorder buffer until the pages before them have been written; no page is requested more than
+		2 * workers pages ahead of the next one to be written.  The pages are all downloads within the sync session already open, so they are
+		requested without the session lock and up to workers of them are in flight at once."""
+		pending = {}
+		nextpage = firstpage
+		with ThreadPoolExecutor(max_workers=workers) as pool:
+			for dlpage in range(firstpage,lastpage + 1):
+				while nextpage <= lastpage and nextpage < dlpage + 2 * workers:
+					pending[nextpage] = pool.submit(self.download,data_element,list(fields),dltype,pagesize=pagesize,page=nextpage,locked=False)
+					nextpage += 1
+				self._write_response(pending.pop(dlpage).result())
+				self._mark_written(progressname,dlpage)
+	
+	def _mark_written(self,progressname,page):
+		"""Flushes the write file and records page as the last page fully written to it, along with the length of the file at that point."""
+		self.writefile.flush()
+		with open(progressname,'wb') as progressfile:
+			pickle.dump((page, fstat(self.writefile.fileno()).st_size),progressfile,protocol=3)
+		
+	def download_columnar(self,data_element,fields,dltype,destfilename=None,format='parquet',expand_codes=False):
+		"""Downloads every record of the current sync session to a Parquet or Arrow file instead of a CSV, with a schema derived from the element's field types.
+		If destfilename is not given the file is named for the element, operation and sync window and placed in soap_path.
+		Returns the name of the file written."""
+		from .export import ColumnarSink
 		recordcount = self.getcount(data_element,dltype)
+		if destfilename is None:
+			destfilename = soap_path + '%s_%s_%s_%s.%s' % ((data_element, dltype) + self.syncwindow + (format,))
+		sink = ColumnarSink(destfilename,data_element,fields,format=format,expand_codes=expand_codes)
+		pagesize = pagelimits.get(data_element,100)
 		dlpage = 1
-		self._prep_writefile(destfilename)
-		while (dlpage - 1) * 100 < recordcount:
-			self.dl_write(data_element,fields,dltype,pagesize=100,page=dlpage)
-			dlpage += 1
-		self._close_writefile()
+		try:
+			while (dlpage - 1) * pagesize < recordcount:
+				sink.write(self.download(data_element,list(fields),dltype,pagesize=pagesize,page=dlpage))
+				dlpage += 1
+		finally:
+			sink.close()
+		return destfilename
 		
 	def dl_write(self,data_element,fields,dltype,pagesize=100,page=1):
-		dl = self.download(data_element,fields,dltype,pagesize=pagesize,page=page)
+		self._write_response(self.download(data_element,fields,dltype,pagesize=pagesize,page=page))
+	
+	def _write_response(self,dl):
 		if not self.write_initialized:
 			self.writer.writerow(dl.results_header())
 			self.write_initialized = True
 		self.writer.writerows(dl.list_results())
 			
-	def download(self,data_element,fields,dltype,pagesize=100,page=1):
+	def download(self,data_element,fields,dltype,pagesize=100,page=1,locked=True):
 		"""Download records that were inserted/updated/deleted within the parameters of an active sync session.
 		Because of pagination limits this will need to be iterated through to capture the full set of records available, if the number is greater than 200.
 		data_element may be any valid Record type from Luminate.
-		optype must be 'insert', 'update', or 'delete'"""
+		optype must be 'insert', 'update', or 'delete'
+		locked=False sends the request without taking the session lock, for fetching pages of the open sync session concurrently."""
 		operation = syncsessiontags[dltype]
 		self._sync_op_checks(data_element,operation)
-		sr = self.request()
+		sr = self.request(locked=locked)
 		r = recordtypes[data_element]
 		fields = r.prepsort(fields)
 		req = element(urn,operation,parent=sr.body)
@@ -192,26 +334,38 @@ class SOAPSession():
 		
 		return sr.response
 		
-	def gettypedescription(self,data_element):
+	def gettypedescription(self,data_element,refresh=False):
 		"""Requests the type description of a Record type from Luminate.
-		Returns a Data_Element object of that type."""
+		Returns a Data_Element object of that type.  With refresh, the response cache is bypassed and updated with the new description."""
 		sr = self.request()
+		sr.refresh = refresh
 		request = element(urn,'DescribeRecordType',parent=sr.body)
 		rt = element(urn,'RecordType',parent=request,text=data_element)
 		sr.submit()
 		return Data_Element(sr.response.tree)
 
 
-def purge_descriptions():
-	"""Updates the module-level saved dictionary of Luminate data elements and fields with a new call to the SOAP API."""
-	ss = SOAPSession()
+def purge_descriptions(ss=None):
+	"""Updates the module-level saved dictionary of Luminate data elements and fields with a new call to the SOAP API, never from the response cache.
+	Uses the SOAPSession ss if one is passed, otherwise opens a new one."""
+	if ss is None:
+		ss = SOAPSession()
 	global recordtypes
 	recordtypes = {}
 	for data_el in ifdrec:
-		recordtypes[data_el] = ss.gettypedescription(data_el)
+		recordtypes[data_el] = ss.gettypedescription(data_el,refresh=True)
 	with open(soap_path + 'record_descriptions.pk3','wb') as descr_file:
 		pickle.dump(recordtypes,descr_file,protocol=3)
-	del ss
+	
+
+def open_sessions(accounts):
+	"""Opens a SOAPSession for each (username, password) pair in accounts, logging in to any that have no saved session id in parallel.
+	Returns the sessions in the same order as accounts."""
+	if len(accounts) == 0:
+		return []
+	with ThreadPoolExecutor(max_workers=len(accounts)) as pool:
+		futures = [pool.submit(SOAPSession,username=username,pw=pw) for (username, pw) in accounts]
+		return [future.result() for future in futures]
 	
 
 def check_op_validity(data_element,operation):
@@ -225,4 +379,4 @@ def check_op_validity(data_element,operation):
 		raise SOAPClientError('Attempted invalid operation %s on record type %s' % (operation, data_element))
 		
 if recordtypes == {}:
-	purge_descriptions()
\ No newline at end of file
+	purge_descriptions()
@@ -1,12 +1,25 @@
 
 
 import requests
-from .utilities import element
+from .utilities import element, sortable, moment
 from .exceptions import SOAPError, SOAPClientError
 from .local_settings import *
+from . import data_structures
+from .cache import ResponseCache
+from .tracing import trace
+from itertools import product
+from datetime import date
 import re
 import lxml.etree as ET		
 
+#opt-in on-disk cache of responses to describe, count, download and query requests
+if settings.get('response_cache'):
+	response_cache = ResponseCache(settings['response_cache'],ttl=settings.get('response_cache_ttl',86400),maxsize=settings.get('response_cache_size',1024**3))
+else:
+	response_cache = None
+#type descriptions can always be reused; counts, downloads and queries only when they cover a window that has already ended
+cacheable_ops = ['DescribeRecordType']
+
 	
 
 class SOAPRequest():
@@ -14,11 +27,18 @@ class SOAPRequest():
 	Optional arguments:
 	session - the ID of the session
 	parent - the SOAPSession object initialized with that session id. 
+	locked - whether the request is sent holding the parent session's lock; requests that don't need to be serialized on the session,
+	like queries, still have the parent for logging in again if the session has expired.
 	
 	Both optional arguments are provided automatically if the object is created by an existing, logged in SOAP session."""
-	def __init__(self,session='',parent=None):
+	def __init__(self,session='',parent=None,locked=True):
 		self.envelope = element(soap,'Envelope')
 		self.parent = parent
+		self.locked = locked and parent is not None
+		self.window = None
+		self.relogged = False
+		#a refresh is always sent to Luminate, and its response replaces whatever the response cache held for it
+		self.refresh = False
 		
 		
 		self.tree = ET.ElementTree(self.envelope)
@@ -30,14 +50,26 @@ class SOAPRequest():
 		
 	def submit(self):
 		"""Submit the SOAP Request.  The response received is a SOAPResponse object stored as the response attribute of the SOAPRequest object."""
-		if self.parent is not None:
+		cachekey = self.cache_key()
+		cached = None
+		if cachekey is not None and not self.refresh:
+			cached = response_cache.get(cachekey)
+		if cached is not None:
+			self.xmltext = cached
+			self.response = SOAPResponse(cached.encode('utf-8'))
+			trace('cached')
+			return
+		if self.locked:
 			self.parent.lock.acquire()
+			trace('lock')
 		try:
+			trace('sent')
 			result = requests.post(soap_endpoint,ET.tostring(self.tree.getroot()))
-			if self.parent is not None:
+			trace('received')
+			if self.locked:
 				self.parent.lock.release()
 		except:
-			if self.parent is not None:
+			if self.locked:
 				self.parent.lock.release()
 			raise
 		stripns1 = re.sub(' xmlns(?:\:[^"]+)?="[^"]+"','',result.text)
@@ -52,6 +84,7 @@ class SOAPRequest():
 		self.xmltext = stripns
 		try:
 			self.response = SOAPResponse(stripns.encode('utf-8'))
+			trace('parsed')
 		except ET.XMLSyntaxError:
 			print(self.xmltext)
 			
@@ -62,26 +95,45 @@ class SOAPRequest():
 		except AssertionError:
 			faultcode = self.response.tree.find('.//faultcode').text
 			faultstring = self.response.tree.find('.//faultstring').text
-			if faultcode == 'SESSION':
-				try:
-					assert self.parent.loginfail
-				except (AssertionError, AttributeError):
-					self.parent.loginfail = True
-					self.parent.login()
-					self.sid.text = self.parent.session
-					self.submit()
+			if faultcode == 'SESSION' and self.parent is not None and hasattr(self,'sid') and not self.relogged:
+				#the session id has expired (or a saved one was stale); log in again, or pick up the id another thread has just logged in for,
+				#and send the request once more.  A second SESSION fault is raised.
+				self.relogged = True
+				self.sid.text = self.parent.relogin(self.sid.text)
+				self.submit()
 			else:
 				raise SOAPError(faultcode + ' fault during request submission',faultcode,faultstring)
-		try:
-			self.parent.loginfail = False
-		except AttributeError:
-			pass
+		else:
+			if cachekey is not None:
+				response_cache.put(cachekey,stripns)
+	
+	def cache_key(self):
+		"""Returns the response cache key for this request, or None if caching is off or this is not a request whose response can be reused.
+		Type descriptions are keyed on the request body alone.  Counts and downloads are keyed on the body and the window of the session's sync,
+		and queries on the body and the window they were made for (see SOAPQuery); either is only cached if its window ended before today,
+		since records can still arrive in a window that hasn't.  The session id in the header is never part of the key."""
+		if response_cache is None or len(self.body) == 0:
+			return None
+		op = ET.QName(self.body[0]).localname
+		window = None
+		if op.startswith('GetIncremental'):
+			window = getattr(self.parent,'syncwindow',None)
+		elif op == 'Query':
+			window = self.window
+		elif op in cacheable_ops:
+			return response_cache.key(ET.tostring(self.body[0]))
+		if window is None or window[1] >= date.today().isoformat():
+			return None
+		return response_cache.key(ET.tostring(self.body[0]),window)
 		
 		
 class SOAPQuery(SOAPRequest):	
-	"""Specialized class of SOAP request for queries."""
-	def __init__(self,session,querytext,parent=None,pagesize=100,page=1):
-		super().__init__(session=session,parent=parent)
+	"""Specialized class of SOAP request for queries.
+	window is the (start, end) isodates the query is bounded to, if it is; only such queries can be answered from the response cache."""
+	def __init__(self,session,querytext,parent=None,pagesize=100,page=1,window=None):
+		#queries don't depend on the session's sync state, so the threads sharing a session can run them side by side
+		super().__init__(session=session,parent=parent,locked=False)
+		self.window = window
 		self.query = element(urn,'Query',parent=self.body)
 		qt = element(urn,'QueryString',parent=self.query,text=querytext)
 		qp = element(urn,'Page',parent=self.query,text=str(page))
@@ -125,22 +177,33 @@ class SOAPResponse():
 		"""Returns a list of the records in the xml document, with each record as a list of the values in that record.  
 		Values are presented in the same order as fields in the field header.
 		Values are not decoded; integer codes in Luminate are presented as integers."""
+		return list(self.iter_results(header=header))
+
+	def iter_results(self,header='',multiple=()):
+		"""Generator version of list_results, producing the records one at a time as they are read.
+		Columns whose positions are in multiple always hold a list of their values, however many there are."""
+		return self._rows(self._match_header(header),multiple)
+
+	def _match_header(self,header):
+		#field names are matched to the capitalization they have in the response, in place
 		if header == '':
-			header = self.results_header()
-		else:
-			caps = self.results_header()
-			lower = [col.lower() for col in caps]
-			for i in range(len(header)):
-				try:
-					header[i] = caps[lower.index(header[i])]
-				except ValueError:
-					pass
-		results = []
+			return self.results_header()
+		caps = self.results_header()
+		lower = [col.lower() for col in caps]
+		for i in range(len(header)):
+			try:
+				header[i] = caps[lower.index(header[i])]
+			except ValueError:
+				pass
+		return header
+
+	def _rows(self,header,multiple):
 		for rec in self.tree.iterfind('.//Record'):
 			row = []
-			for col in header:
-				els = [el for el in rec.iterfind('.//' + col)]
-				if len(els) == 0:
+			for i in range(len(header)):
+				#a Parent.Child path only finds the child inside that parent, so fields sharing a name under different parents stay apart
+				els = [el for el in rec.iterfind('.//' + header[i].replace('.','/'))]
+				if len(els) == 0 and i not in multiple:
 					row.append('')
 				else:
 					toappend = []
@@ -150,11 +213,97 @@ class SOAPResponse():
 							toappend.append(el.text.replace('\t','').replace('\\','').replace('\n',' '))
 						elif el.get('nil') == 'true':
 							toappend.append('')
-					if len(toappend) == 1:
+					if len(toappend) == 1 and i not in multiple:
 						row.append(toappend[0])
 					else:
 						row.append(toappend)
-			results.append(row)
-		return results
+			yield row
+
+	def field_paths(self,header):
+		"""Returns the path of each field in header as it sits in the records of this response: Parent.Child for a field inside a complex field,
+		or just the name for a field of the record itself.  Fields that appear in no record are returned as they are."""
+		paths = []
+		for col in header:
+			el = self.tree.find('.//Record//' + col)
+			if el is None:
+				paths.append(col)
+				continue
+			parts = [el.tag]
+			parent = el.getparent()
+			while parent is not None and parent.tag != 'Record':
+				parts.insert(0,parent.tag)
+				parent = parent.getparent()
+			paths.append('.'.join(parts))
+		return paths
+
+	def multiple_columns(self,data_element,header):
+		"""Returns the positions of the fields in header that the Luminate description of data_element marks as multi-valued."""
+		try:
+			el = data_structures.recordtypes[data_element]
+		except KeyError:
+			return []
+		return [i for (i, path) in enumerate(self.field_paths(header)) if el.is_multiple(path)]
+
+	def explode_results(self,data_element,header=''):
+		"""Returns a generator of the records as rows for loading.  A relation-style response, of a key and one field that the Luminate description
+		of data_element marks as multi-valued (ConsGroupRel's consid and groupid, for example), gives one (key, value) row per value, and records
+		with no values give no rows.  Any other response gives one row per record, as iter_results does.  Rows are produced lazily, a record
+		at a time, so they can be streamed into the database."""
+		header = self._match_header(header)
+		rows = self._rows(header,())
+		if len(header) != 2:
+			return rows
+		multiple = self.multiple_columns(data_element,header)
+		if len(multiple) != 1:
+			return rows
+		return _explode(self._rows(header,multiple),multiple)
+
+	def seek(self,pk,after=None):
+		"""Prepares a keyset paginated response.  Records whose primary key is at or below after are dropped from the tree,
+		the number of records originally returned is kept as .rawcount and the key of the last remaining record as .lastkey (None if nothing remains)."""
+		records = [rec for rec in self.tree.iterfind('.//Record')]
+		self.rawcount = len(records)
+		self.lastkey = None
+		for rec in records:
+			key = sortable(rec.findtext('.//' + pk))
+			if after is not None and key <= after:
+				rec.getparent().remove(rec)
+			else:
+				self.lastkey = key
+
+	def max_value(self,field):
+		"""Returns the latest value of the named time field among the records in this response, compared chronologically (see utilities.moment),
+		or None if there are no such values."""
+		values = [rec.findtext('.//' + field) for rec in self.tree.iterfind('.//Record')]
+		values = [val for val in values if val]
+		if len(values) == 0:
+			return None
+		return max(values,key=moment)
+
+	def columns(self,header='',multiple=()):
+		"""Returns a tuple of the field header and the results as a list of columns rather than rows, one list of values per field.
+		Columns whose positions are in multiple hold a list of values for every record (see iter_results)."""
+		header = self._match_header(header)
+		rows = list(self._rows(header,multiple))
+		if len(rows) == 0:
+			return (header, [[] for col in header])
+		return (header, [list(col) for col in zip(*rows)])
 	
-	
\ No newline at end of file
+	def typed_columns(self,data_element,header='',expand_codes=False):
+		"""Returns the results as a dictionary of field name : column of python values, decoded according to the Luminate description of data_element.
+		Multi-valued fields are decoded to a list for every record, however many values it has.
+		With expand_codes, coded fields are decoded to the names of their options."""
+		header = self._match_header(header)
+		(header, cols) = self.columns(header=header,multiple=self.multiple_columns(data_element,header))
+		return data_structures.recordtypes[data_element].decode(header,cols,expand_codes=expand_codes)
+
+
+
+def _explode(rows,multiple):
+	"""Yields a row for every combination of the values in the multi-valued columns of each row, at the positions listed in multiple."""
+	for row in rows:
+		for values in product(*[row[i] for i in multiple]):
+			out = list(row)
+			for (i, val) in zip(multiple,values):
+				out[i] = val
+			yield out
@@ -0,0 +1,139 @@
+#checks gap detection and patching end to end against a fake database cursor and SOAP session, so no login or postgres is needed
+#run from the directory above the package with: python -m unittest <package>.tests.test_gaps
+
+import re
+import unittest
+from ..controller import Controller
+from ..rangeset import RangeSet
+from ..local_settings import pks
+
+(EL, PK) = sorted(pks.items())[0]
+OPN = EL.lower()
+
+
+class FakeResponse():
+	def __init__(self,ids):
+		self.ids = list(ids)
+		self.rawcount = len(self.ids)
+		self.lastkey = self.ids[-1] if self.ids else None
+
+	def list_results(self,header=''):
+		return [[str(id)] for id in self.ids]
+
+	def explode_results(self,data_element,header=''):
+		return ([str(id)] for id in self.ids)
+
+
+class FakeSession():
+	"""Answers key-only keyset queries and patch queries from a fixed set of remote ids."""
+	def __init__(self,remote):
+		self.remote = sorted(remote)
+
+	def query_fields(self,el,fields,op,pagesize=100,page=1,querytype='time',whereclause=None,keyset=False,after=None,**kwargs):
+		ids = [id for id in self.remote if after is None or id > after]
+		return FakeResponse(ids[(page - 1) * pagesize:page * pagesize])
+
+	def query(self,querytext,pagesize=100,page=1,window=None):
+		wanted = set(int(id) for id in re.findall(r'= (\d+)',querytext))
+		return FakeResponse(id for id in self.remote if id in wanted)
+
+
+class FakeNamedCursor():
+	def __init__(self,ids):
+		self.ids = ids
+		self.itersize = 2000
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self,*args):
+		return False
+
+	def execute(self,sql):
+		pass
+
+	def __iter__(self):
+		return iter([(id,) for id in sorted(self.ids)])
+
+
+class FakeCursor():
+	"""Keeps the rows copied into the loader table and records what each db_load call was handed."""
+	def __init__(self,local,gaps=()):
+		self.local = local
+		self.gaps = list(gaps)
+		self.connection = self
+		self.statements = []
+		self.result = []
+		self.loader = []
+		self.loads = []
+
+	def cursor(self,name=None):
+		return FakeNamedCursor(self.local)
+
+	def execute(self,sql):
+		self.statements.append(sql)
+		self.result = []
+		if sql.startswith('SELECT element FROM sync_ops'):
+			self.result = [(EL,)]
+		elif sql.startswith('SELECT field FROM luminate_fields'):
+			self.result = [(PK,)]
+		elif sql.startswith('SELECT column_name'):
+			self.result = [(PK.lower(),)]
+		elif sql.startswith('SELECT %s FROM %s_gaps' % (PK, OPN)):
+			(self.result, self.gaps) = ([(id,) for id in self.gaps[:100]], self.gaps[100:])
+		elif sql.startswith('TRUNCATE'):
+			self.loader = []
+		else:
+			load = re.match(r"SELECT db_load\('(\w+)','(\w+)'\)",sql)
+			if load:
+				self.loads.append((load.group(1), load.group(2), sorted(int(id) for id in self.loader)))
+				self.loader = []
+
+	def fetchone(self):
+		return self.result[0]
+
+	def fetchall(self):
+		return self.result
+
+	def copy_from(self,file,table,null='',columns=None):
+		self.loader.extend(file.read().splitlines())
+
+
+def controller(local,remote,gaps=()):
+	ctrl = Controller.__new__(Controller)
+	ctrl.db = FakeCursor(local,gaps)
+	ctrl.session = FakeSession(remote)
+	ctrl.paths = {(OPN, 'insert'): (EL, 'query')}
+	return ctrl
+
+
+class GapTest(unittest.TestCase):
+	def setUp(self):
+		#enough remote ids to take several key-only pages, with two that were deleted in Luminate and ten we never loaded
+		self.remote = RangeSet(range(1,451)) - RangeSet([100,200])
+		self.local = RangeSet(list(range(1,441)) + [500])
+
+	def test_find_gaps(self):
+		ctrl = controller(self.local,self.remote)
+		(missing, deleted) = ctrl.find_gaps(OPN)
+		self.assertEqual(list(missing),list(range(441,451)))
+		self.assertEqual(list(deleted),[100,200,500])
+		self.assertEqual(ctrl.db.loads,[])
+
+	def test_gaps_patched(self):
+		ctrl = controller(self.local,self.remote)
+		ctrl.find_gaps(OPN,patch=True)
+		#inserts and deletes are both merged under the opname
+		self.assertEqual(ctrl.db.loads,[(OPN, 'insert', list(range(441,451))), (OPN, 'delete', [100,200,500])])
+
+	def test_patch_from_gaps_table(self):
+		ctrl = controller(self.local,self.remote,gaps=range(300,451))
+		ctrl.patch(OPN)
+		self.assertEqual([load[:2] for load in ctrl.db.loads],[(OPN, 'insert'), (OPN, 'insert')])
+		self.assertEqual(sum((load[2] for load in ctrl.db.loads),[]),list(range(300,451)))
+		resolved = [sql for sql in ctrl.db.statements if sql.startswith('UPDATE')]
+		self.assertTrue(resolved and all(sql.startswith('UPDATE %s_gaps' % OPN) for sql in resolved))
+
+
+if __name__ == '__main__':
+	unittest.main()
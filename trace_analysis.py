@@ -0,0 +1,163 @@
+#offline analysis of the page life cycle traces written by tracing.py
+#usage: python trace_analysis.py tracefile
+#kept free of the rest of the package so that it can be run anywhere a trace file has been copied to
+
+import json
+import sys
+
+#the phases of a unit, each measured from the first event named to the second
+phases = [('queue wait','enqueued','dequeued'),
+	('lock wait','dequeued','lock'),
+	('http','sent','received'),
+	('parse','received','parsed'),
+	('db queue wait','queued','db_dequeued'),
+	('copy','db_dequeued','copied'),
+	('commit','copied','committed')]
+waits = ['queue wait','lock wait','db queue wait']
+
+
+def load(path):
+	"""Reads a trace file, returning its events sorted by time."""
+	events = []
+	with open(path,'rt') as tracefile:
+		for line in tracefile:
+			line = line.strip()
+			if line:
+				events.append(json.loads(line))
+	events.sort(key=lambda ev: ev['t'])
+	return events
+
+def unit_timelines(events):
+	"""Groups events by unit.  Returns a dictionary of unit : {event name : [times]}."""
+	units = {}
+	for ev in events:
+		units.setdefault(ev['unit'],{}).setdefault(ev['ev'],[]).append(ev['t'])
+	return units
+
+def phase_times(timeline):
+	"""Returns a dictionary of phase name : seconds for one unit's timeline.  Repeated events (retried pages, re-logins) are paired up in order
+	and summed; phases whose events are missing are left out."""
+	durations = {}
+	for (name, start, end) in phases:
+		if start not in timeline or end not in timeline:
+			continue
+		total = 0
+		for (t0, t1) in zip(timeline[start],timeline[end]):
+			total += max(t1 - t0,0)
+		durations[name] = total
+	return durations
+
+def thread_intervals(events):
+	"""Returns a dictionary of thread name : list of (start, end, unit) busy intervals.
+	A download thread is busy from dequeuing a unit to its last event on that unit, the db thread from db_dequeued to committed."""
+	intervals = {}
+	open_units = {}
+	for ev in events:
+		(th, name) = (ev['th'], ev['ev'])
+		if name in ('dequeued','db_dequeued'):
+			if th in open_units:
+				(unit, start, last) = open_units[th]
+				intervals.setdefault(th,[]).append((start,last,unit))
+			open_units[th] = (ev['unit'],ev['t'],ev['t'])
+		elif th in open_units and open_units[th][0] == ev['unit']:
+			(unit, start, last) = open_units[th]
+			open_units[th] = (unit,start,ev['t'])
+			if name in ('queued','committed'):
+				intervals.setdefault(th,[]).append((start,ev['t'],unit))
+				del open_units[th]
+	for (th, (unit, start, last)) in open_units.items():
+		intervals.setdefault(th,[]).append((start,last,unit))
+	return intervals
+
+def critical_path(events,units,intervals):
+	"""Walks back from the last unit to be committed to find the chain of units that determined when the run finished.
+	A unit that sat in the task queue was waiting on whatever its thread did before it; a unit that was enqueued late was waiting on the unit
+	completed just before it was enqueued.  Returns the chain as a list of units, earliest first."""
+	finished = {}
+	for (unit, timeline) in units.items():
+		ends = timeline.get('committed',[]) + timeline.get('queued',[])
+		if ends:
+			finished[unit] = max(ends)
+	if not finished:
+		return []
+	unit = max(finished,key=finished.get)
+	#the unit each download thread worked on before this one, and when it finished with it
+	previous = {}
+	for (th, spans) in intervals.items():
+		for i in range(1,len(spans)):
+			previous[(th, spans[i][2])] = (spans[i-1][2], spans[i-1][1])
+	threadof = {}
+	for ev in events:
+		if ev['ev'] == 'dequeued':
+			threadof[ev['unit']] = ev['th']
+	chain = [unit]
+	seen = set(chain)
+	while True:
+		timeline = units[unit]
+		enqueued = min(timeline['enqueued']) if 'enqueued' in timeline else None
+		pred = None
+		if enqueued is not None:
+			(prev, prevend) = previous.get((threadof.get(unit), unit),(None, None))
+			if prev is not None and prevend > enqueued:
+				#the thread was still busy with prev when this unit was enqueued
+				pred = prev
+			else:
+				before = [(t, u) for (u, t) in finished.items() if t <= enqueued and u not in seen]
+				if before:
+					pred = max(before)[1]
+		if pred is None or pred in seen:
+			break
+		chain.append(pred)
+		seen.add(pred)
+		unit = pred
+	chain.reverse()
+	return chain
+
+def report(path,out=sys.stdout):
+	"""Prints a summary of a trace file: time spent waiting versus being serviced in each phase, how busy each thread was,
+	and the critical path of units through the run."""
+	events = load(path)
+	if not events:
+		out.write('empty trace\n')
+		return
+	units = unit_timelines(events)
+	(first, last) = (events[0]['t'], events[-1]['t'])
+	span = last - first
+	out.write('%s events, %s units over %.1f seconds\n\n' % (len(events), len(units), span))
+
+	totals = {}
+	counts = {}
+	per_unit = {}
+	for (unit, timeline) in units.items():
+		per_unit[unit] = phase_times(timeline)
+		for (name, secs) in per_unit[unit].items():
+			totals[name] = totals.get(name,0) + secs
+			counts[name] = counts.get(name,0) + 1
+	out.write('%-16s%12s%12s%10s\n' % ('phase','total s','mean s','units'))
+	for (name, start, end) in phases:
+		if name in totals:
+			out.write('%-16s%12.2f%12.3f%10d\n' % (name, totals[name], totals[name]/counts[name], counts[name]))
+	waited = sum(totals.get(name,0) for name in waits)
+	serviced = sum(secs for (name, secs) in totals.items() if name not in waits)
+	out.write('\nwaiting %.1f s, in service %.1f s\n\n' % (waited, serviced))
+
+	intervals = thread_intervals(events)
+	out.write('%-16s%12s%12s%8s\n' % ('thread','busy s','idle s','idle %'))
+	for th in sorted(intervals):
+		busy = sum(end - start for (start, end, unit) in intervals[th])
+		idle = max(span - busy,0)
+		out.write('%-16s%12.1f%12.1f%8.1f\n' % (th, busy, idle, 100 * idle / span if span else 0))
+
+	chain = critical_path(events,units,intervals)
+	out.write('\ncritical path, %s units:\n' % len(chain))
+	pathtotals = {}
+	for unit in chain:
+		times = per_unit[unit]
+		for (name, secs) in times.items():
+			pathtotals[name] = pathtotals.get(name,0) + secs
+		out.write('  %s  %s\n' % (unit, '  '.join('%s %.2f' % (name, times[name]) for (name, s, e) in phases if name in times)))
+	out.write('critical path by phase: %s\n' % '  '.join('%s %.1f' % (name, pathtotals[name]) for (name, s, e) in phases if name in pathtotals))
+
+
+if __name__ == '__main__':
+	report(sys.argv[1])
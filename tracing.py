@@ -0,0 +1,55 @@
+#opt-in recorder for the life cycle of each page downloaded by the controller, for working out afterwards where a slow sync spent its time
+#the recorded file is read by trace_analysis.py
+
+from .local_settings import settings
+from threading import Lock, local, current_thread
+from time import time
+import json
+
+
+class TraceRecorder():
+	"""Appends one compact JSON line per event to a trace file.  Each event carries the time, the event name, the unit of work it belongs to
+	and the name of the thread recording it.  Events raised deep in the request code without a unit of their own are attributed to the unit
+	the current thread was last set to work on, and dropped if there is none."""
+	def __init__(self,path):
+		self.file = open(path,'at',buffering=1)
+		self.lock = Lock()
+		self.local = local()
+
+	def set_unit(self,unit):
+		self.local.unit = unit
+
+	def record(self,event,unit=None,**extra):
+		if unit is None:
+			unit = getattr(self.local,'unit',None)
+			if unit is None:
+				return
+		rec = {'t' : round(time(),6), 'ev' : event, 'unit' : unit, 'th' : current_thread().name}
+		rec.update(extra)
+		line = json.dumps(rec,separators=(',',':'))
+		with self.lock:
+			self.file.write(line + '\n')
+
+
+if settings.get('trace_file'):
+	tracer = TraceRecorder(settings['trace_file'])
+else:
+	tracer = None
+
+
+def unit_key(opn,op,start_date,page):
+	"""Returns the identifier of a Download_Instructions unit in the trace: opname/operation/window start/page.
+	A page shared by several opnames is identified by their names joined with +."""
+	if type(opn) == tuple:
+		opn = '+'.join(opn)
+	return '%s/%s/%s/%s' % (opn, op, start_date, str(page))
+
+def trace(event,unit=None,**extra):
+	"""Records an event if tracing is switched on."""
+	if tracer is not None:
+		tracer.record(event,unit,**extra)
+
+def trace_unit(unit):
+	"""Sets the unit of work the current thread's events belong to."""
+	if tracer is not None:
+		tracer.set_unit(unit)
@@ -2,7 +2,7 @@
 import lxml.etree as ET			
 from .local_settings import ns, soap_path
 from .interface_data import recordtypes as ifdrec
-from datetime import date
+from datetime import date, datetime, timedelta, timezone
 import dateutil.parser as dp
 from time import mktime
 
@@ -30,4 +30,36 @@ def isodate_to_jsdate(isodate):
 	unixdate = mktime(pydate.timetuple())
 	jsdate = unixdate * 1000
 	return jsdate
-	
\ No newline at end of file
+
+def sortable(val):
+	"""Returns a value from a Luminate record in a form that compares the way the interface sorts it:
+	integer ids and javascript style dates as integers, everything else (including isodates) as strings."""
+	if val is None:
+		return ''
+	try:
+		return int(val)
+	except ValueError:
+		return val
+
+def moment(val):
+	"""Returns a time field value from a Luminate record in a form that compares chronologically: javascript style dates as integers,
+	isodates as timezone aware datetimes (taken as UTC if they carry no offset), so values written with different offsets compare correctly."""
+	try:
+		return int(val)
+	except ValueError:
+		pass
+	parsed = dp.parse(val)
+	if parsed.tzinfo is None:
+		parsed = parsed.replace(tzinfo=timezone.utc)
+	return parsed
+
+def watermark_floor(watermark,overlap,longdate=False):
+	"""Steps back overlap seconds from a stored high watermark.
+	Returns a tuple of the resulting moment formatted for use in a query, and the isodate of the day it falls on."""
+	if longdate:
+		floor = int(watermark) - overlap * 1000
+		return (str(floor), datetime.utcfromtimestamp(floor / 1000).date().isoformat())
+	floor = dp.parse(watermark) - timedelta(seconds=overlap)
+	if floor.tzinfo is not None:
+		floor = floor.astimezone(timezone.utc).replace(tzinfo=None)
+	return (floor.strftime('%Y-%m-%dT%H:%M:%S') + '+0000', floor.date().isoformat())